@@ -0,0 +1,205 @@
+# -*- encoding: utf-8 -*-
+
+from datetime import datetime
+from contextlib import contextmanager
+import threading
+
+from django.db import transaction, connection
+
+
+'''
+Write-behind buffer, that saves new versions of documents in batches
+'''
+
+
+# the maximum pause (seconds) of the background thread after failures
+MAX_BACKOFF = 60
+
+
+class BufferedWriter(object):
+    '''
+    Collects new versions of documents of one **model** and saves them
+    with **bulk_documents_save**.
+
+    Each call gets **document_start** at once: all calls between two
+    flushes share the time of the first of them (the start of the
+    batch). Several versions of the same document in one batch are
+    collapsed to the last one, that would otherwise give phantoms.
+
+    :param flush_size: the number of documents, that triggers a flush
+    :param flush_interval: maximum time (seconds) the documents are
+        kept in the buffer by the background thread
+    :param background: if False, there is no background thread and
+        the buffer is flushed only when **flush_size** is reached,
+        or by **flush** and **commit_on_success**.
+
+    Documents with ids of versions, that are not current any more, are
+    not saved, but collected in **conflicts** (see the **conflicts**
+    parameter of **bulk_documents_save**). A flush outside of a managed
+    transaction saves all batches in one transaction. If it fails, the
+    documents are returned to the buffer to be saved by the next one.
+
+    :param max_retries: the number of failed flushes of the background
+        thread (repeated with growing pauses), after which the documents
+        are saved one by one, and the failing ones are moved to
+        **failed** as (document, exception) pairs.
+    '''
+
+    def __init__(self, model, flush_size=1000, flush_interval=1.0,
+                 background=True, max_retries=3):
+        self.model = model
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._batches = []  # [document_start, {key: document}, auto]
+        self._size = 0
+        self._error = None
+        self.conflicts = []
+        self.failed = []
+        self._closed = False
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def document_save(self, document, document_start=None):
+        '''
+        Queue the new version of the **document** (see
+        Document.document_save), the version is saved on flush.
+        '''
+        assert document.__class__ is self.model
+        with self._cond:
+            self._raise_error()
+            assert not self._closed
+            auto = document_start is None
+            if not self._batches or self._batches[-1][2] != auto or \
+                    not auto and self._batches[-1][0] != document_start:
+                self._batches.append(
+                        [document_start or datetime.now(), {}, auto])
+            start, documents, auto = self._batches[-1]
+            if document.document_start is not None:
+                assert document.document_start <= start
+            key = document.document_id or ('new', id(document))
+            if key not in documents:
+                self._size += 1
+            documents[key] = document
+            document.document_start = start
+            full = self._size >= self.flush_size
+            if full:
+                self._cond.notify()
+        if full and self._thread is None:
+            self.flush()
+
+    def flush(self):
+        '''
+        Save all queued documents (in the current transaction), return
+        the conflicting ones (they are added to **conflicts** too)
+        '''
+        with self._cond:
+            self._raise_error()
+        return self._flush()
+
+    @contextmanager
+    def commit_on_success(self):
+        '''
+        Like **transaction.commit_on_success**, but flushes the writer
+        before the commit
+        '''
+        with transaction.commit_on_success():
+            yield self
+            self.flush()
+
+    def close(self):
+        '''
+        Stop the background thread and flush the remaining documents
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _flush(self, isolate=False):
+        '''
+        Save the queued batches, or (if **isolate**) each document in
+        its own transaction, moving the failing ones to **failed**
+        '''
+        with self._flush_lock:
+            with self._cond:
+                batches, self._batches, self._size = self._batches, [], 0
+            state = [(d, d.id, d.document_id)
+                     for _, documents, _ in batches
+                     for d in documents.values()]
+            conflicts = []
+            try:
+                if isolate:
+                    self._save_each(batches, conflicts)
+                elif transaction.is_managed():
+                    self._save(batches, conflicts)
+                else:
+                    # all or nothing, so the failed flush can be repeated
+                    with transaction.commit_on_success():
+                        self._save(batches, conflicts)
+            except Exception:
+                # the transaction is rolled back, queue them again
+                for d, id_, document_id in state:
+                    d.id, d.document_id = id_, document_id
+                with self._cond:
+                    self._batches[:0] = batches
+                    self._size += len(state)
+                raise
+            with self._cond:
+                self.conflicts.extend(conflicts)
+            return conflicts
+
+    def _save(self, batches, conflicts):
+        for start, documents, auto in batches:
+            self.model.bulk_documents_save(
+                    documents.values(), start, conflicts=conflicts)
+
+    def _save_each(self, batches, conflicts):
+        for start, documents, auto in batches:
+            for d in documents.values():
+                id_, document_id = d.id, d.document_id
+                try:
+                    with transaction.commit_on_success():
+                        self.model.bulk_documents_save(
+                                [d], start, conflicts=conflicts)
+                except Exception as e:
+                    d.id, d.document_id = id_, document_id
+                    with self._cond:
+                        self.failed.append((d, e))
+
+    def _run(self):
+        failures = 0
+        try:
+            while True:
+                with self._cond:
+                    if failures and not self._closed:
+                        # do not repeat the failed flush at once
+                        self._cond.wait(min(
+                                self.flush_interval * 2 ** failures,
+                                MAX_BACKOFF))
+                    elif not self._closed and self._size < self.flush_size:
+                        self._cond.wait(self.flush_interval)
+                    closed = self._closed
+                try:
+                    self._flush(isolate=failures >= self.max_retries)
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    with self._cond:
+                        self._error = e
+                if closed:
+                    break
+        finally:
+            connection.close()
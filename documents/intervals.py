@@ -0,0 +1,112 @@
+# -*- encoding: utf-8 -*-
+
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+from django.db import models
+
+from documents.utils import vlist_blocker
+
+
+'''
+In-memory index of the versions of documents for repeated point in time
+lookups (document_get by document_id) in batch jobs
+'''
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _key(dt):
+    # microseconds from EPOCH as float, exact for +- 285 years, monotonic
+    # (but rounded) further, that is enough for datetime.max
+    d = dt - EPOCH
+    return (d.days * 86400 + d.seconds) * 1e6 + d.microseconds
+
+
+class IntervalIndex(object):
+    '''
+    Loads the intervals (document_id, document_start, document_end, id)
+    of all versions of the **model** (filtered by **kwargs**) once, read
+    in blocks of **blocksize** (see utils.vlist_blocker), into arrays
+    sorted by document_id and document_start.
+
+    Lookups are binary searches in memory, the versions themselves are
+    read lazily by **get_many** in batches of **fetch_size** and cached
+    (see **clear**). The index does not see the changes made after
+    loading.
+    '''
+
+    def __init__(self, model, blocksize=100000, fetch_size=1000, **kwargs):
+        self.model = model
+        self.fetch_size = fetch_size
+        self._document_ids = array('l')
+        self._offsets = array('l')      # the first version of the document
+        self._starts = array('d')
+        self._ends = array('d')
+        self._ids = array('l')
+        self._cache = {}
+        vlist = model.objects.filter(
+                document_start__lt=models.F('document_end'), **kwargs)\
+            .order_by('document_id', 'document_start')\
+            .values_list('document_id', 'document_start', 'document_end',
+                         'id')
+        for document_id, start, end, id_ in vlist_blocker(vlist, blocksize):
+            if not self._document_ids or \
+                    self._document_ids[-1] != document_id:
+                self._document_ids.append(document_id)
+                self._offsets.append(len(self._ids))
+            self._starts.append(_key(start))
+            self._ends.append(_key(end))
+            self._ids.append(id_)
+        self._offsets.append(len(self._ids))
+
+    def __len__(self):
+        ''' the number of versions '''
+        return len(self._ids)
+
+    def version_id(self, dt, document_id):
+        '''
+        Identifier of the version of the document **document_id** at the
+        moment **dt**, None if the document did not exist then.
+        '''
+        i = bisect_left(self._document_ids, document_id)
+        if i == len(self._document_ids) or \
+                self._document_ids[i] != document_id:
+            return None
+        lo, hi = self._offsets[i], self._offsets[i + 1]
+        k = _key(dt)
+        j = bisect_right(self._starts, k, lo, hi) - 1
+        if j >= lo and k < self._ends[j]:
+            return self._ids[j]
+        return None
+
+    def get_many(self, lookups):
+        '''
+        List of the versions for the (dt, document_id) pairs of
+        **lookups** (None for the documents, that did not exist at dt)
+        '''
+        ids = [self.version_id(dt, document_id)
+               for dt, document_id in lookups]
+        missing = list(set(id_ for id_ in ids
+                           if id_ is not None and id_ not in self._cache))
+        for i in range(0, len(missing), self.fetch_size):
+            self._cache.update(self.model.objects.in_bulk(
+                    missing[i:i + self.fetch_size]))
+        return [None if id_ is None else self._cache[id_] for id_ in ids]
+
+    def document_get(self, dt, document_id):
+        '''
+        Like Document.document_get(dt, document_id=document_id)
+        '''
+        document, = self.get_many([(dt, document_id)])
+        if document is None:
+            raise self.model.DoesNotExist(
+                    '%s with document_id %s does not exist at %s'
+                    % (self.model.__name__, document_id, dt))
+        return document
+
+    def clear(self):
+        ''' forget the versions read by get_many '''
+        self._cache.clear()
@@ -0,0 +1,33 @@
+# -*- encoding: utf-8 -*-
+
+'Print changes of documents from the change log'
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from documents.models import DocumentChange, DocumentChangeCursor
+
+
+class Command(BaseCommand):
+    help = 'Print changes of documents (see Document.document_changelog) ' \
+           'since the position of the cursor and move it'
+    args = '<cursor name>'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=1000,
+                    help='maximum number of changes to print'),
+        make_option('--peek', action='store_true', default=False,
+                    help='do not move the cursor'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: documentschanges %s' % self.args)
+        name = args[0]
+        changes = DocumentChange.since(name, options['limit'])
+        for c in changes:
+            self.stdout.write('%d %s %s %d %s %s\n' % (
+                    c.id, c.kind, c.model, c.document_id,
+                    c.version_id or '-', c.time))
+        if changes and not options['peek']:
+            DocumentChangeCursor.advance(name, changes[-1])
@@ -0,0 +1,127 @@
+# -*- encoding: utf-8 -*-
+
+'Restore all documents to their state at given time'
+
+from datetime import datetime
+from optparse import make_option
+from time import time
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_models, Q, ForeignKey
+from django.db import transaction, connection
+
+from documents.models import Document, DocumentPartB, FUTURE, \
+        RESTORE_CHUNK
+from documents.management.commands.documentscheck import \
+        info, warning, error, set_options
+
+
+FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def parse_datetime(s):
+    for f in FORMATS:
+        try:
+            return datetime.strptime(s, f)
+        except ValueError:
+            pass
+    raise CommandError('illegal datetime: %s' % s)
+
+
+def b_parts(model):
+    '''
+    DocumentPartB models linking to the versions of the **model**
+    '''
+    return [m for m in get_models() if issubclass(m, DocumentPartB)
+            and [f for f in m._meta.fields
+                 if isinstance(f, ForeignKey) and f.rel.to is model]]
+
+
+def rewind_model(model, dt, chunk):
+    mn = model.__name__
+    if model._meta.parents or model.document_children():
+        warning(mn + ': skipped, bulk_restore_to does not support '
+                     'multi-table inheritance')
+        return
+    if b_parts(model):
+        warning(mn + ': skipped, bulk_restore_to does not copy parts '
+                     '(DocumentPartB) linking to it')
+        return
+    info('rewinding model : ' + mn)
+    # the documents changed after dt
+    document_ids = list(model.objects.filter(
+            Q(document_start__gt=dt) |
+            Q(document_end__gt=dt, document_end__lte=FUTURE))
+            .order_by('document_id').values_list('document_id', flat=True)
+            .distinct())
+    started = time()
+    for i in range(0, len(document_ids), chunk):
+        # the time of each transaction, as documents could be saved
+        # while the command runs
+        with transaction.commit_on_success():
+            model.bulk_restore_to(dt, document_ids[i:i + chunk])
+        n = min(i + chunk, len(document_ids))
+        info(mn + ': %d/%d document(s) restored, %.1f/s'
+             % (n, len(document_ids), n / max(time() - started, 1e-6)))
+    if document_ids:
+        warning(mn + ': %d document(s) restored in %.1fs'
+                % (len(document_ids), time() - started))
+    else:
+        info(mn + ': no documents changed')
+
+
+def rewind(out, err, dt, **options):
+    set_options(out, err, **options)
+    if dt >= datetime.now():
+        raise CommandError('%s is not in the past' % dt)
+    chunk = int(options['chunk'])
+    todo = [m for m in get_models() if issubclass(m, Document)]
+    lock = threading.Lock()
+    failed = []
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    if not todo:
+                        return
+                    model = todo.pop(0)
+                try:
+                    rewind_model(model, dt, chunk)
+                except Exception as e:
+                    error(model.__name__ + ': %s' % e)
+                    failed.append(model.__name__)
+        finally:
+            connection.close()
+
+    jobs = int(options['jobs'])
+    if jobs <= 1:
+        for m in todo:
+            rewind_model(m, dt, chunk)
+        return
+    threads = [threading.Thread(target=worker) for i in range(jobs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if failed:
+        raise CommandError('rewinding failed for: ' + ', '.join(failed))
+
+
+class Command(BaseCommand):
+    help = 'Restore all document subclasses to their state at given time ' \
+           '(see Document.bulk_restore_to)'
+    args = '<datetime>'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk', type='int', default=RESTORE_CHUNK,
+                    help='the number of documents restored '
+                         'in one transaction'),
+        make_option('--jobs', type='int', default=1,
+                    help='the number of models restored in parallel'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: documentsrewind %s' % self.args)
+        rewind(self.stdout, self.stderr, parse_datetime(args[0]), **options)
@@ -6,7 +6,7 @@ from django.core.management.base import NoArgsCommand
 from django.db.models import get_models
 from django.db import transaction
 
-from documents.models import Document, FUTURE
+from documents.models import Document, DeltaDocument, FUTURE
 from documents.management.commands.documentscheck import \
         info, warning, set_options
 
@@ -18,6 +18,11 @@ def fix_model(model):
 
     oc = model.objects.count()
     info(mn + ' %d records total' % oc)
+    if issubclass(model, DeltaDocument):
+        c = model.delta_materialize(
+                model.objects.filter(document_end__gte=FUTURE))
+        if c:
+            info(mn + ': %d delta-encoded document(s) materialized' % c)
     model.objects.filter(document_end__lt=FUTURE).delete()
     c = oc - model.objects.update(document_start=datetime.min)
     if c:
@@ -5,12 +5,19 @@ from datetime import datetime
 from django.core.management.base import NoArgsCommand
 from django.db.models import get_models
 
-from documents.models import Document, FUTURE
+from documents.models import Document, DeltaDocument, FUTURE
 from documents.utils import vlist_blocker
 from documents.management.commands.documentscheck import \
         info, warning, set_options
 
 
+def delete_version(model, document_id, id_):
+    if issubclass(model, DeltaDocument):
+        model.delta_materialize(model.objects.filter(
+                document_id=document_id).exclude(id=id_))
+    model.objects.filter(id=id_).delete()
+
+
 def fix_model (model):
     mn = model.__name__
     info('fixing model : ' + mn)
@@ -26,7 +33,7 @@ def fix_model (model):
                 pe = datetime.max
 
             if e < pe:
-                model.objects.filter(id=id_).delete()
+                delete_version(model, did, id_)
                 warning('document_id: %d, id: %d new overlapped interval'
                           ' removed (%s)' % (did, id_, mn))
                 continue
@@ -35,7 +42,7 @@ def fix_model (model):
                 warning('document_id: %d, id: %d old overlapped interval'
                           ' truncated (%s)' % (did, pid, mn))
             else:
-                model.objects.filter(id=pid).delete()
+                delete_version(model, did, pid)
                 warning('document_id: %d, id: %d overlapped interval'
                           ' removed (%s)' % (did, pid, mn))
         pid, pdid, ps, pe = id_, did, s, e
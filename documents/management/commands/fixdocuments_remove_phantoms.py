@@ -3,7 +3,7 @@
 from django.core.management.base import NoArgsCommand
 from django.db.models import get_models, F
 
-from documents.models import Document
+from documents.models import Document, DeltaDocument
 from documents.management.commands.documentscheck import \
         info, warning, set_options
 
@@ -14,6 +14,13 @@ def fix_model(model):
 
     c = model.objects.filter(document_start__gte=F('document_end')).count()
     if c:
+        if issubclass(model, DeltaDocument):
+            # the remaining versions of these documents
+            model.delta_materialize(model.objects.filter(
+                    document_id__in=model.objects
+                    .filter(document_start__gte=F('document_end'))
+                    .values('document_id'),
+                    document_start__lt=F('document_end')))
         model.objects.filter(document_start__gte=F('document_end')).delete()
         warning(mn + ': %d phantom document(s) removed' % c)
     else:
@@ -1,17 +1,134 @@
 # -*- encoding: utf-8 -*-
 
-from datetime import datetime
-
-from django.db import models, transaction, connection, DEFAULT_DB_ALIAS
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import reduce
+from itertools import groupby, islice
+import hashlib
+import json
+import operator
+import zlib
+
+from django.db import models, transaction, connection, connections, \
+        router, DEFAULT_DB_ALIAS
+from django.db.backends.util import truncate_name
+from django.db.models import Q, get_models
+from django.db.models.signals import post_syncdb
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.utils.encoding import smart_str
 
 from documents.retrospection import now
+from documents import prepared
+from documents.utils import vlist_blocker
 
 
 # far enough in the future, but less then document.max
 FUTURE = datetime(3000, 1, 1)
 
+# the number of documents restored by one statement in bulk_restore_to
+RESTORE_CHUNK = 10000
+
+# the number of documents deleted by one statement in bulk_documents_delete
+DELETE_CHUNK = 10000
+
+
+def _engine():
+    return settings.DATABASES[DEFAULT_DB_ALIAS]['ENGINE']
+
+
+_row_types = {}
+
+
+def row_type(model, fields):
+    '''
+    namedtuple class for rows with given **fields** of the **model**
+    '''
+    key = (model, tuple(fields))
+    if key not in _row_types:
+        _row_types[key] = namedtuple(
+                model.__name__ + 'Row', fields, rename=True)
+    return _row_types[key]
+
+
+class VersionRecord(object):
+    '''
+    Mixin for the tuples of **record_type**: read-only version without
+    the overhead of a model instance, see DocumentPart.history_records
+    '''
+
+    __slots__ = ()
+
+    def instance(self):
+        '''
+        The model instance for this version (read from the database,
+        unless the record has all fields)
+        '''
+        model = self._model
+        if self._names == tuple(f.name for f in model._meta.fields):
+            document = model(*self)
+            document._state.db = DEFAULT_DB_ALIAS
+            document._state.adding = False
+            return document
+        return model.objects.get(
+                pk=self[self._names.index(model._meta.pk.name)])
+
+
+_record_types = {}
+
+
+def record_type(model, fields):
+    '''
+    VersionRecord class (a namedtuple) for given **fields** of the
+    **model**, they should include the primary key.
+    '''
+    key = (model, tuple(fields))
+    if key not in _record_types:
+        _record_types[key] = type(model.__name__ + 'Record',
+                (row_type(model, fields), VersionRecord),
+                {'__slots__': (), '_model': model, '_names': key[1]})
+    return _record_types[key]
+
+
+def _insert_order(classes):
+    '''
+    **classes** sorted so, that the models linked to (by foreign keys)
+    go before the models linking to them
+    '''
+    order, visiting = [], set()
+
+    def visit(c):
+        if c in order:
+            return
+        if c in visiting:
+            raise DocumentPart.ConfigurationError(
+                    'Cyclic links between %s' % c.__name__)
+        visiting.add(c)
+        for f in c._meta.fields:
+            if isinstance(f, models.ForeignKey) and f.rel.to is not c \
+                    and f.rel.to in classes:
+                visit(f.rel.to)
+        order.append(c)
+
+    for c in classes:
+        visit(c)
+    return order
+
+
+def _resolve_links(objects):
+    '''
+    Set the foreign keys of **objects** from the related instances
+    assigned to them (those could have no ids at the time)
+    '''
+    for o in objects:
+        for f in o._meta.fields:
+            if isinstance(f, models.ForeignKey):
+                related = getattr(o, f.get_cache_name(), None)
+                if related is not None:
+                    setattr(o, f.attname, getattr(
+                            related, f.rel.get_related_field().attname))
+
 
 class DocumentPartNowManager(models.Manager):
     ''' 
@@ -77,6 +194,140 @@ class DocumentPart(models.Model):
         d.update(kwargs)
         return cls.objects.filter(**d).order_by('-' + tm + '__document_start')
 
+    def history_records(self, fields=None, **kwargs):
+        '''
+        Iterator on the history (see **history**) as VersionRecord
+        tuples with **fields** (all by default, the primary key is
+        added if missing), without creating model instances.
+        '''
+        fields = self._record_fields(fields)
+        record = record_type(self.__class__, fields)
+        return (record._make(r) for r in
+                self.history(**kwargs).values_list(*fields).iterator())
+
+    @classmethod
+    def _record_fields(cls, fields):
+        if fields is None:
+            return [f.name for f in cls._meta.fields]
+        fields = list(fields)
+        if cls._meta.pk.name not in fields:
+            fields.append(cls._meta.pk.name)
+        return fields
+
+    @classmethod
+    def at_tuples(cls, dt, fields, blocksize=None, **kwargs):
+        '''
+        Iterator on tuples with values of **fields** of the document parts
+        at given dt, without creating model instances.
+
+        :param blocksize: if given, read in blocks of this size
+            (see utils.vlist_blocker)
+        '''
+        fields = list(fields)
+        vlist = cls.at(dt, **kwargs)
+        if not blocksize:
+            return vlist.values_list(*fields).iterator()
+        pk = cls._meta.pk.name
+        n = len(fields)
+        return (r[:n] for r in vlist_blocker(
+                vlist.values_list(*(fields + [pk])).order_by(pk), blocksize))
+
+    @classmethod
+    def at_values(cls, dt, fields, blocksize=None, **kwargs):
+        '''
+        Like **at_tuples**, but yields namedtuples with **fields**
+        '''
+        row = row_type(cls, fields)
+        return (row._make(r) for r in
+                cls.at_tuples(dt, fields, blocksize, **kwargs))
+
+    @classmethod
+    def id_model(cls):
+        '''
+        The model, that declares the **id** field: cls itself or, with
+        multi-table inheritance, its parent
+        '''
+        return cls._meta.get_field('id').model
+
+    @classmethod
+    def bulk_ids(cls, n):
+        assert n >= 0
+        if n == 0:
+            return []
+        model = cls.id_model()
+        if 'postgresql' in _engine():
+            cursor = connection.cursor()
+            sql = "select nextval('%s_id_seq') from generate_series(1,%d)"\
+                    % (model._meta.db_table, n)
+            cursor.execute(sql)
+            return [int(r[0]) for r in cursor]
+        elif 'sqlite' in _engine():
+            m = model.objects.aggregate(models.Max('id'))['id__max']
+            if m is None:
+                m = 0
+            return range(m + 1, n + m + 1)
+        raise NotImplementedError
+
+    @classmethod
+    def bulk_insert(cls, documents):
+        '''
+        Insert **documents** with the ids set. With multi-table
+        inheritance the tables of parents are inserted into first, the
+        links to the parents are set from their primary keys.
+        '''
+        if not documents:
+            return
+        if cls._meta.parents:
+            cls._bulk_insert_tables(documents)
+        elif hasattr(cls.objects, 'bulk_create'):  # added in Django 1.4
+            cls.objects.bulk_create(documents)
+        else:
+            cls._bulk_insert_custom(documents)
+
+    @classmethod
+    def _bulk_insert_tables(cls, documents):
+        # the fields of documents (instances of cls or its child), that
+        # are stored in the tables of cls and its parents
+        for parent, link in cls._meta.parents.items():
+            parent._bulk_insert_tables(documents)
+            attname = link.rel.get_related_field().attname
+            for d in documents:
+                setattr(d, link.attname, getattr(d, attname))
+        cls._bulk_insert_custom(documents, cls._meta.local_fields)
+
+    @classmethod
+    def _bulk_insert_custom(cls, documents, fields=None):
+        '''
+        Insert the values of **fields** (all by default) of **documents**
+        to the table of cls
+        '''
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        fields = fields or cls._meta.fields
+        table = cls._meta.db_table
+        flds = ', '.join(qn(f.column) for f in fields)
+        # sqlite INSERT can not process many values in one query
+        if 'sqlite' in _engine():
+            values_list = [[f.get_db_prep_save(getattr(d, f.attname),
+                                               connection=connection)
+                              for f in fields] for d in documents]
+            arg_string = '(' + ', '.join(['%s'] * len(fields)) + ')'
+            sql = 'INSERT INTO %s(%s) VALUES %s' \
+                    % (table, flds, arg_string)
+            cursor.executemany(sql, values_list)
+        else:
+            values_list = [f.get_db_prep_save(getattr(d, f.attname),
+                                              connection=connection)
+                            for d in documents for f in fields]
+            arg_string = ', '.join(
+                    ['(' + ', '.join(['%s'] * len(fields)) + ')']
+                    * len(documents))
+            sql = 'INSERT INTO %s(%s) VALUES %s' \
+                    % (table, flds, arg_string)
+            cursor.execute(sql, values_list)
+        cursor.close()
+        transaction.commit_unless_managed()
+
     objects = models.Manager()      # use the default one
     now = DocumentPartNowManager()  # at current time
 
@@ -98,10 +349,33 @@ class Document(DocumentPart):
     class ChangedAlready(Exception):
         pass
 
+    # kinds of changes, see changes_between
+    CREATED, UPDATED, DELETED = 'created', 'updated', 'deleted'
+
     objects = models.Manager()  # use the default one
     now = DocumentNowManager()  # at current time
 
-    def document_save(self, document_start=None):
+    # fields, that are not compared by document_unchanged
+    document_system_fields = (
+            'id', 'document_start', 'document_end', 'document_id')
+
+    # save new versions with one statement on PostgreSQL (without
+    # calling save and sending signals), see _document_save_returning
+    document_save_returning = False
+
+    # serialize writers of the same document with advisory locks on
+    # PostgreSQL, see document_locking
+    document_advisory_lock = False
+
+    # run document_get by document_id and the closing of versions as
+    # prepared statements on PostgreSQL, see documents.prepared (only
+    # for long-lived connections, not for web requests)
+    document_prepared = False
+
+    # write new versions and deletions to DocumentChange
+    document_changelog = False
+
+    def document_save(self, document_start=None, skip_if_unchanged=False):
         '''
         Save the new version of the document
 
@@ -115,15 +389,61 @@ class Document(DocumentPart):
            will be the time of the start of new version, and the end of the
            old version. 
            
+        :param skip_if_unchanged: if True, the new version is not saved
+           when it does not differ from the current one (and the instance
+           gets the identifier and the times of the current version). The
+           number of skipped documents (0 or 1) is returned in this case.
+
         Should be overriden in compound documents to get consistent verions 
        (as different parts might be saved at different times), and links
         from the old parts might need updating too.
         '''
+        return self.document_locking([self.document_id], self._document_save,
+                                     document_start, skip_if_unchanged)
+
+    def _document_save(self, document_start, skip_if_unchanged):
+        if skip_if_unchanged:
+            current = self.document_current()
+            if current is not None and self.document_unchanged(current):
+                self.document_skip(current)
+                return 1
         if self.document_start is not None and document_start is not None:
             assert self.document_start <= document_start
         self.document_start = document_start or datetime.now()
         self.document_end = datetime.max
-        if self.document_id and self.id:
+        if self.document_save_returning and 'postgresql' in _engine() \
+                and self._meta.pk.name == u'id' and not self._meta.parents \
+                and not self._save_overridden() \
+                and not self._new_document_id_overridden():
+            self._document_save_returning()
+        else:
+            self._document_close()
+            self.id = self.pk = None  # for inheriting models, where pk != id
+            if self.document_id == 0 and self._meta.pk.name == u'id' and \
+                    'postgresql' in _engine():
+                # allocate id (nextval) before insert to avoid the second
+                # update, MAX(id) + 1 elsewhere is not safe for concurrent
+                # inserts
+                self.id = self.pk = self.bulk_ids(1)[0]
+                self.document_id = self.new_document_id()
+            self.save(force_insert=True)
+            if self.document_id == 0:
+                self.document_id = self.new_document_id()
+                self.save(force_update=True)
+        self.document_log(DocumentChange.SAVED,
+                          [(self.document_id, self.id)], self.document_start)
+        if skip_if_unchanged:
+            return 0
+
+    def _document_close(self):
+        '''
+        Close the current version before saving the new one
+        '''
+        if self.document_id and self._use_prepared():
+            if self._close_prepared(self.document_start, self.document_id,
+                                    self.id) != 1 and self.id:
+                raise self.ChangedAlready()
+        elif self.document_id and self.id:
             if self.__class__.objects\
                     .filter(id=self.id,
                             document_id=self.document_id,
@@ -135,26 +455,184 @@ class Document(DocumentPart):
                 .filter(document_id=self.document_id,
                          document_end__gt=FUTURE)\
                 .update(document_end=self.document_start)
-        self.id = self.pk = None  # for inheriting models, where pk != id
-        self.save(force_insert=True)
-        if self.document_id == 0:
-            self.document_id = self.new_document_id()
-            self.save(force_update=True)
+
+    @classmethod
+    def _save_overridden(cls):
+        # the single statement of _document_save_returning would bypass
+        # save() of the model (e.g. DeltaDocument.save)
+        save = getattr(cls.save, '__func__', cls.save)
+        return save is not getattr(models.Model.save, '__func__',
+                                   models.Model.save)
+
+    @classmethod
+    def _new_document_id_overridden(cls):
+        # _document_save_returning assigns the new id as document_id
+        f = getattr(cls.new_document_id, '__func__', cls.new_document_id)
+        return f is not getattr(Document.new_document_id, '__func__',
+                                Document.new_document_id)
+
+    def _document_save_returning(self):
+        '''
+        Close the current version, insert the new one and assign
+        document_id (equal to the new id for new documents) in one
+        statement. Only for PostgreSQL and models with "id" primary key,
+        that do not override new_document_id.
+        '''
+        cls = self.__class__
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        fields = [f for f in cls._meta.local_fields
+                  if f.name not in ('id', 'document_id')]
+        params = []
+        sql = 'WITH '
+        if self.document_id:
+            sql += 'closed AS (UPDATE %s SET document_end = %%s ' \
+                   'WHERE document_id = %%s AND document_end > %%s%s ' \
+                   'RETURNING id), ' \
+                   % (table, ' AND id = %s' if self.id else '')
+            params += [self.document_start, self.document_id, FUTURE]
+            if self.id:
+                params.append(self.id)
+        sql += "new AS (SELECT nextval('%s_id_seq') AS id) " \
+               'INSERT INTO %s (id, document_id, %s) ' \
+               'SELECT new.id, COALESCE(NULLIF(%%s, 0), new.id), %s ' \
+               'FROM new%s RETURNING id, document_id' \
+               % (cls._meta.db_table, table,
+                  ', '.join(qn(f.column) for f in fields),
+                  ', '.join(['%s'] * len(fields)),
+                  ' WHERE (SELECT count(*) FROM closed) = 1'
+                  if self.document_id and self.id else '')
+        params.append(self.document_id)
+        params += [f.get_db_prep_save(f.pre_save(self, True),
+                                      connection=connection)
+                   for f in fields]
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        cursor.close()
+        transaction.commit_unless_managed()
+        if row is None:
+            raise self.ChangedAlready()
+        self.id = self.pk = int(row[0])
+        self.document_id = int(row[1])
 
     def save_now(self):
         self.document_save(now())
 
+    def document_current(self):
+        '''
+        Current version of this document, or None
+        '''
+        if not self.document_id:
+            return None
+        current = list(self.__class__.objects.filter(
+                document_id=self.document_id, document_end__gt=FUTURE)[:1])
+        return current[0] if current else None
+
+    @classmethod
+    def document_fields(cls):
+        '''
+        Fields with the data of the document (not the versioning ones)
+        '''
+        return [f for f in cls._meta.fields
+                if not f.primary_key and not isinstance(f, models.AutoField)
+                and f.name not in cls.document_system_fields]
+
+    def document_unchanged(self, current):
+        '''
+        True if this version has the same data as the **current** one, and
+        was created from it (or without the identifier of the version).
+        '''
+        if self.id and self.id != current.id:
+            return False  # will fail with ChangedAlready
+        return all(getattr(self, f.attname) == getattr(current, f.attname)
+                   for f in self.document_fields())
+
+    def document_skip(self, current):
+        '''
+        Take the identifier and the times of the **current** version
+        instead of saving the new one.
+        '''
+        self.pk = current.pk
+        self.id = current.id
+        self.document_start = current.document_start
+        self.document_end = current.document_end
+
     def new_document_id(self):
         return self.id
 
     def document_delete(self, delete_time=None):
-        return self.__class__.objects.filter(
-                document_id=self.document_id, document_end__gt=FUTURE)\
-               .update(document_end=delete_time or datetime.now())
+        delete_time = delete_time or datetime.now()
+        if self._use_prepared():
+            n = self._close_prepared(delete_time, self.document_id)
+        else:
+            n = self.__class__.objects.filter(
+                    document_id=self.document_id, document_end__gt=FUTURE)\
+                   .update(document_end=delete_time)
+        if n:
+            self.document_log(DocumentChange.DELETED,
+                              [(self.document_id, None)], delete_time)
+        return n
 
     def delete_now(self):
         return self.document_delete(now())
 
+    @classmethod
+    def document_get(cls, dt, **kwargs):
+        if list(kwargs) == ['document_id'] and cls._use_prepared():
+            return cls._document_get_prepared(dt, kwargs['document_id'])
+        return super(Document, cls).document_get(dt, **kwargs)
+
+    @classmethod
+    def _use_prepared(cls):
+        # not for other databases, see documents.routers
+        return cls.document_prepared and 'postgresql' in _engine() \
+               and cls._meta.pk.name == u'id' and not cls._meta.parents \
+               and router.db_for_read(cls) == DEFAULT_DB_ALIAS
+
+    @classmethod
+    def _document_get_prepared(cls, dt, document_id):
+        qn = connection.ops.quote_name
+        sql = 'SELECT %s FROM %s WHERE document_id = %%s ' \
+              'AND document_start <= %%s AND document_end > %%s LIMIT 2' \
+              % (', '.join(qn(f.column) for f in cls._meta.fields),
+                 qn(cls._meta.db_table))
+        cursor = prepared.execute(sql, [document_id, dt, dt])
+        rows = cursor.fetchall()
+        cursor.close()
+        if not rows:
+            raise cls.DoesNotExist('%s matching query does not exist.'
+                                   % cls._meta.object_name)
+        if len(rows) > 1:
+            raise cls.MultipleObjectsReturned(
+                    'get() returned more than one %s'
+                    % cls._meta.object_name)
+        document = cls(*rows[0])
+        document._state.db = DEFAULT_DB_ALIAS
+        document._state.adding = False
+        if issubclass(cls, DeltaDocument):
+            cls.delta_restore([document])
+        return document
+
+    @classmethod
+    def _close_prepared(cls, document_end, document_id, id=None):
+        '''
+        Close the current version of the document (only if it has given
+        **id**), return the number of closed versions.
+        '''
+        sql = 'UPDATE %s SET document_end = %%s ' \
+              'WHERE document_id = %%s AND document_end > %%s' \
+              % connection.ops.quote_name(cls._meta.db_table)
+        params = [document_end, document_id, FUTURE]
+        if id:
+            sql += ' AND id = %s'
+            params.append(id)
+        cursor = prepared.execute(sql, params)
+        closed = cursor.rowcount
+        cursor.close()
+        transaction.commit_unless_managed()
+        return closed
+
     @classmethod
     def document_get_or_404(cls, dt, **kwargs):
         return get_object_or_404(
@@ -174,6 +652,130 @@ class Document(DocumentPart):
             document_start__lt=models.F('document_end'), **kwargs
             ).order_by('-document_start')
 
+    @classmethod
+    def changes_between(cls, t1, t2, blocksize=100000, **kwargs):
+        '''
+        Iterator on (kind, document_id, id) for the documents changed in
+        the interval (t1, t2], in the order of document_id. Uses one
+        query (read in blocks, see utils.vlist_blocker) for the versions
+        starting or ending in the interval.
+
+        kind is CREATED (the document did not exist at t1), UPDATED or
+        DELETED (does not exist at t2), id is the identifier of the version
+        at t2 (at t1 for deleted documents). Documents created and deleted
+        inside the interval are skipped. **kwargs** filter the versions, so
+        they should not depend on the changing fields.
+        '''
+        vlist = cls.objects.filter(
+                models.Q(document_start__gt=t1, document_start__lte=t2) |
+                models.Q(document_end__gt=t1, document_end__lte=t2),
+                document_start__lt=models.F('document_end'), **kwargs)\
+            .order_by('document_id', 'document_start')\
+            .values_list('document_id', 'id',
+                         'document_start', 'document_end')
+        for document_id, versions in groupby(
+                vlist_blocker(vlist, blocksize), operator.itemgetter(0)):
+            before = after = None
+            for _, id_, s, e in versions:
+                if s <= t1 < e:
+                    before = id_
+                if s <= t2 < e:
+                    after = id_
+            if before is not None and after is not None:
+                yield cls.UPDATED, document_id, after
+            elif after is not None:
+                yield cls.CREATED, document_id, after
+            elif before is not None:
+                yield cls.DELETED, document_id, before
+
+    @classmethod
+    def _versions_sql(cls, start, end, fields, **kwargs):
+        '''
+        SQL and params of the query for **fields** of the versions
+        overlapping [start, end] (filtered by **kwargs**)
+        '''
+        qset = cls.objects.filter(document_end__gt=start,
+                                  document_start__lte=end, **kwargs)\
+                          .values(*fields)
+        return qset.query.get_compiler(DEFAULT_DB_ALIAS).as_sql()
+
+    @classmethod
+    def timeline_counts(cls, start, end, step, **kwargs):
+        '''
+        List of (t, the number of documents existing at t) for t from
+        **start** to **end** (including) with **step** (timedelta).
+        **kwargs** filter the versions.
+        '''
+        assert step > timedelta(0)
+        if 'postgresql' in _engine():
+            sql, params = cls._versions_sql(
+                    start, end, ('document_start', 'document_end'), **kwargs)
+            cursor = connection.cursor()
+            cursor.execute(
+                    'SELECT t.t, count(v.document_start) '
+                    'FROM generate_series(%%s::timestamp, %%s::timestamp, '
+                    '%%s::interval) AS t(t) '
+                    'LEFT JOIN (%s) AS v ON v.document_start <= t.t '
+                    'AND t.t < v.document_end GROUP BY t.t ORDER BY t.t'
+                    % sql, (start, end, step) + tuple(params))
+            return list(cursor.fetchall())
+        points = []
+        t = start
+        while t <= end:
+            points.append(t)
+            t += step
+        counts = [0] * (len(points) + 1)
+        vlist = cls.objects.filter(document_end__gt=start,
+                                   document_start__lte=end, **kwargs)\
+                           .order_by('id')\
+                           .values_list('id', 'document_start', 'document_end')
+        for _, s, e in vlist_blocker(vlist):
+            counts[bisect_left(points, s)] += 1
+            counts[bisect_left(points, e)] -= 1
+        result, n = [], 0
+        for t, c in zip(points, counts):
+            n += c
+            result.append((t, n))
+        return result
+
+    @classmethod
+    def time_weighted(cls, field, start, end, **kwargs):
+        '''
+        Average of **field** over the versions existing in [start, end]
+        (filtered by **kwargs**), weighted by the time each version
+        exists in the interval. None if there are no such versions.
+        '''
+        kwargs[field + '__isnull'] = False
+        if 'postgresql' in _engine():
+            sql, params = cls._versions_sql(
+                    start, end, (field, 'document_start', 'document_end'),
+                    **kwargs)
+            duration = 'EXTRACT(EPOCH FROM LEAST(v.document_end, %s) - ' \
+                       'GREATEST(v.document_start, %s))'
+            cursor = connection.cursor()
+            cursor.execute('SELECT sum(v.%s * %s) / nullif(sum(%s), 0) '
+                           'FROM (%s) AS v'
+                           % (connection.ops.quote_name(
+                                   cls._meta.get_field(field).column),
+                              duration, duration, sql),
+                           (end, start, end, start) + tuple(params))
+            result = cursor.fetchone()[0]
+            return None if result is None else float(result)
+        total = weights = 0
+        vlist = cls.objects.filter(document_end__gt=start,
+                                   document_start__lte=end, **kwargs)\
+                           .order_by('id')\
+                           .values_list('id', field,
+                                        'document_start', 'document_end')
+        for _, value, s, e in vlist_blocker(vlist):
+            d = min(e, end) - max(s, start)
+            w = d.days * 86400 + d.seconds + d.microseconds / 1e6
+            total += float(value) * w
+            weights += w
+        if not weights:
+            return None
+        return float(total) / weights
+
     def document_restore(self, document_start=None):
         ''' 
         Restore the document from the previous verions(in other words,
@@ -186,6 +788,10 @@ class Document(DocumentPart):
         links to this document from the objects that were linking to the
         previous version.
         '''
+        return self.document_locking([self.document_id],
+                                     self._document_restore, document_start)
+
+    def _document_restore(self, document_start):
         assert self.document_id
         if self.document_end > FUTURE:
             return  # already the last version
@@ -199,21 +805,147 @@ class Document(DocumentPart):
             document_end=self.document_start)
         self.id = self.pk = None  # for inheriting models, where pk != id
         self.save(force_insert=True)
+        self.document_log(DocumentChange.SAVED,
+                          [(self.document_id, self.id)], self.document_start)
 
     def restore_now(self):
         self.document_restore(now())
 
     @classmethod
-    def bulk_documents_save(cls, documents, document_start=None):
+    def document_children(cls):
         '''
-        Save the new versions of documents in bulk
+        Models inheriting from cls with multi-table inheritance
+        '''
+        return [m for m in get_models() if cls in m._meta.parents]
+
+    @classmethod
+    def bulk_restore_to(cls, dt, document_ids=None, document_start=None):
+        '''
+        Restore the documents **document_ids** (all documents by default)
+        to their state at **dt**: the versions existing at dt, that are
+        not current, are copied to new versions starting at
+        **document_start**, the documents created after dt are deleted.
+
+        Uses set-based statements for chunks of RESTORE_CHUNK documents,
+        only for models without parents. Call it in a transaction. The
+        documents restored by a previous call are copied again, as their
+        current versions started after dt.
+        '''
+        assert cls._meta.pk.name == 'id' and not cls._meta.parents
+        assert not cls.document_children(), \
+                'bulk_restore_to does not copy rows of child models'
+        document_start = document_start or datetime.now()
+        assert dt < document_start
+        if document_ids is None:
+            chunks = [None]
+        else:
+            document_ids = list(document_ids)
+            chunks = [document_ids[i:i + RESTORE_CHUNK]
+                      for i in range(0, len(document_ids), RESTORE_CHUNK)]
+        for chunk in chunks:
+            cls.document_locking(chunk or [], cls._restore_chunk,
+                                 dt, document_start, chunk)
+
+    @classmethod
+    def _restore_chunk(cls, dt, document_start, chunk):
+        # the current versions started after dt
+        qset = cls.objects.filter(document_start__gt=dt,
+                                  document_end__gt=FUTURE)
+        if chunk is not None:
+            qset = qset.filter(document_id__in=chunk)
+        assert not qset.filter(document_start__gt=document_start).exists(), \
+                'document_start is earlier than the current versions'
+        closed = []
+        if cls.document_changelog:
+            closed = list(qset.values_list('document_id', flat=True))
+        qset.update(document_end=document_start)
+        restored = set(cls._restore_copy(dt, document_start, chunk))
+        cls.document_log(DocumentChange.DELETED,
+                         [(i, None) for i in closed if i not in restored],
+                         document_start)
+
+    @classmethod
+    def _restore_copy(cls, dt, document_start, chunk):
+        '''
+        Copy the versions at dt, that are closed, to the new versions
+        starting at document_start (with one INSERT ... SELECT), return
+        their document_ids if document_changelog is set.
+        '''
+        qn = connection.ops.quote_name
+        to_db = connection.ops.value_to_db_datetime
+        fields = [f for f in cls._meta.local_fields if f.name != 'id']
+        values = {'document_start': '%s', 'document_end': '%s'}
+        sql = 'INSERT INTO %s (%s) SELECT %s FROM %s ' \
+              'WHERE document_start <= %%s AND document_end > %%s ' \
+              'AND document_end <= %%s' % (
+                qn(cls._meta.db_table),
+                ', '.join(qn(f.column) for f in fields),
+                ', '.join(values.get(f.name, qn(f.column)) for f in fields),
+                qn(cls._meta.db_table))
+        params = [to_db(document_start if f.name == 'document_start'
+                        else datetime.max)
+                  for f in fields if f.name in values]
+        params += [to_db(dt), to_db(dt), to_db(FUTURE)]
+        if chunk is not None:
+            sql += ' AND document_id IN (%s)' % ', '.join(['%s'] * len(chunk))
+            params += chunk
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        cursor.close()
+        transaction.commit_unless_managed()
+        if not cls.document_changelog:
+            return []
+        qset = cls.objects.filter(document_start=document_start,
+                                  document_end__gt=FUTURE)
+        if chunk is not None:
+            qset = qset.filter(document_id__in=chunk)
+        restored = list(qset.values_list('document_id', 'id'))
+        cls.document_log(DocumentChange.SAVED, restored, document_start)
+        return [document_id for document_id, _ in restored]
+
+    @classmethod
+    def bulk_documents_save(cls, documents, document_start=None,
+                            skip_if_unchanged=False, conflicts=None):
         '''
-        assert cls._meta.pk.name == u'id'
+        Save the new versions of documents in bulk
 
+        :param skip_if_unchanged: if True, documents that do not differ
+           from their current versions are not saved (see document_save),
+           and the number of skipped documents is returned.
+
+        :param conflicts: if a list is given, documents with the
+           identifier of the version, that is not current any more, are
+           appended to it and not saved (instead of raising ChangedAlready
+           for the whole batch).
+        '''
         documents = list(documents)
+        return cls.document_locking([d.document_id for d in documents],
+                                    cls._bulk_documents_save, documents,
+                                    document_start, skip_if_unchanged,
+                                    conflicts)
+
+    @classmethod
+    def _bulk_documents_save(cls, documents, document_start,
+                             skip_if_unchanged, conflicts):
         if document_start is None:
             document_start = datetime.now()
 
+        skipped = 0
+        if skip_if_unchanged:
+            current = dict((c.document_id, c) for c in cls.objects.filter(
+                    document_id__in=[d.document_id for d in documents
+                                     if d.document_id],
+                    document_end__gt=FUTURE))
+            changed = []
+            for d in documents:
+                c = current.get(d.document_id)
+                if c is not None and d.document_unchanged(c):
+                    d.document_skip(c)
+                else:
+                    changed.append(d)
+            skipped = len(documents) - len(changed)
+            documents = changed
+
         with_document_id_and_id = []
         with_document_id = []
 
@@ -232,7 +964,17 @@ class Document(DocumentPart):
             elif d.document_id:
                 with_document_id.append(d.document_id)
 
-        if with_document_id_and_id:
+        if with_document_id_and_id and conflicts is not None:
+            closed = set(cls.bulk_close_ids(
+                    with_document_id_and_id, document_start))
+            saved = []
+            for d in documents:
+                if d.document_id and d.id and d.id not in closed:
+                    conflicts.append(d)
+                else:
+                    saved.append(d)
+            documents = saved
+        elif with_document_id_and_id:
             if cls.objects\
                     .filter(id__in=with_document_id_and_id,
                             document_end__gt=FUTURE)\
@@ -252,76 +994,187 @@ class Document(DocumentPart):
             if not d.document_id:
                 d.document_id = d.new_document_id()
         cls.bulk_insert(documents)
+        cls.document_log(DocumentChange.SAVED,
+                         [(d.document_id, d.id) for d in documents],
+                         document_start)
+        if skip_if_unchanged:
+            return skipped
+
+    @classmethod
+    def document_lock(cls, document_ids):
+        '''
+        Lock documents with given identifiers till the end of the
+        transaction. Uses advisory locks on PostgreSQL (in the order of
+        identifiers to avoid deadlocks), does nothing on other databases.
+        '''
+        if 'postgresql' not in _engine() or not document_ids:
+            return
+        cursor = connection.cursor()
+        sql = 'SELECT pg_advisory_xact_lock(%%s, d) FROM ' \
+              '(SELECT d FROM (VALUES %s) AS v(d) ORDER BY d) AS s' \
+              % ', '.join(['(%s)'] * len(document_ids))
+        cursor.execute(sql, [zlib.crc32(smart_str(cls._meta.db_table))
+                             & 0x7fffffff] + list(document_ids))
+        cursor.close()
+
+    @classmethod
+    def document_locking(cls, document_ids, f, *args, **kwargs):
+        '''
+        Call **f** holding the locks on the documents with given
+        identifiers, if document_advisory_lock is set. The call is made
+        in a transaction (a new one, unless it is managed already), so the
+        old version is closed and the new one inserted atomically.
+        '''
+        document_ids = sorted(set(i for i in document_ids if i))
+        if not cls.document_advisory_lock or not document_ids:
+            return f(*args, **kwargs)
+        if transaction.is_managed():
+            cls.document_lock(document_ids)
+            return f(*args, **kwargs)
+        with transaction.commit_on_success():
+            cls.document_lock(document_ids)
+            return f(*args, **kwargs)
+
+    @classmethod
+    def bulk_close_ids(cls, ids, document_end):
+        '''
+        Close current versions with given **ids**, return the ids of
+        the closed ones (others were changed already).
+        '''
+        if 'postgresql' in _engine():
+            cursor = connection.cursor()
+            sql = 'UPDATE %s SET document_end = %%s ' \
+                  'WHERE id IN (%s) AND document_end > %%s RETURNING id' \
+                  % (connection.ops.quote_name(
+                          cls.id_model()._meta.db_table),
+                     ', '.join(['%s'] * len(ids)))
+            cursor.execute(sql, [document_end] + list(ids) + [FUTURE])
+            closed = [int(r[0]) for r in cursor]
+            cursor.close()
+            transaction.commit_unless_managed()
+            return closed
+        closed = list(cls.objects.filter(
+                id__in=ids, document_end__gt=FUTURE)\
+                .values_list('id', flat=True))
+        if closed:
+            cls.objects.filter(id__in=closed, document_end__gt=FUTURE)\
+                    .update(document_end=document_end)
+        return closed
 
     @classmethod
     def bulk_save_now(cls, documents):
         cls.bulk_documents_save(documents, now())
 
     @classmethod
-    def bulk_documents_delete(cls, documents, delete_time=None):
-        if not documents:
-            return 0
-        return cls.objects.filter(
-                document_id__in=[d.document_id for d in documents],
-                document_end__gt=FUTURE)\
-               .update(document_end=delete_time or datetime.now())
+    def bulk_documents_save_with_parts(cls, documents, parts,
+                                       document_start=None):
+        '''
+        Save new versions of compound **documents** (see
+        **bulk_documents_save**) with their new **parts** (instances of
+        DocumentPartF and DocumentPartB subclasses), using one bulk
+        insert per table.
+
+        The links between the objects are taken from the instances
+        assigned to foreign keys (e.g. ``BPart(link=document)``), the
+        ids of parts are allocated in blocks. The tables are inserted
+        into in the order of links: F-parts before the documents,
+        B-parts after them. Call it in a transaction.
+        '''
+        documents = list(documents)
+        by_model = {}
+        for p in parts:
+            assert p.pk is None and not isinstance(p, Document)
+            by_model.setdefault(p.__class__, []).append(p)
+        for model, objects in by_model.items():
+            for id_, p in zip(model.bulk_ids(len(objects)), objects):
+                p.id = id_
+        by_model[cls] = documents
+        for model in _insert_order(list(by_model)):
+            _resolve_links(by_model[model])
+            if model is cls:
+                cls.bulk_documents_save(documents, document_start)
+            else:
+                model.bulk_insert(by_model[model])
 
     @classmethod
-    def bulk_delete_now(cls, documents):
-        return cls.bulk_documents_delete(documents, now())
+    def bulk_documents_delete(cls, documents, delete_time=None,
+                              returning=False):
+        '''
+        Delete **documents** (any iterable), closing their current
+        versions in chunks of DELETE_CHUNK documents. Return the number
+        of deleted documents or, if **returning**, their document_ids
+        (of the documents, that were current).
+        '''
+        delete_time = delete_time or datetime.now()
+        documents = iter(documents)
+        deleted = [] if returning else 0
+        while True:
+            chunk = [d.document_id for d in islice(documents, DELETE_CHUNK)]
+            if not chunk:
+                return deleted
+            deleted += cls._documents_close(cls.objects.filter(
+                    document_id__in=chunk, document_end__gt=FUTURE),
+                    delete_time, returning)
 
     @classmethod
-    def bulk_ids(cls, n):
-        assert n >= 0
-        if n == 0:
-            return []
-        if 'postgresql' in settings.DATABASES[DEFAULT_DB_ALIAS]['ENGINE']:
-            cursor = connection.cursor()
-            sql = "select nextval('%s_id_seq') from generate_series(1,%d)"\
-                    % (cls._meta.db_table, n)
-            cursor.execute(sql)
-            return [int(r[0]) for r in cursor]
-        elif 'sqlite' in settings.DATABASES[DEFAULT_DB_ALIAS]['ENGINE']:
-            m = cls.objects.aggregate(models.Max('id'))['id__max']
-            if m is None:
-                m = 0
-            return range(m + 1, n + m + 1)
-        raise NotImplementedError
+    def bulk_documents_delete_where(cls, delete_time=None, returning=False,
+                                    **filters):
+        '''
+        Delete the documents, whose current versions match **filters**,
+        with one statement and without loading them. Return the number
+        of deleted documents or, if **returning**, their document_ids.
+        '''
+        return cls._documents_close(
+                cls.objects.filter(document_end__gt=FUTURE, **filters),
+                delete_time or datetime.now(), returning)
 
     @classmethod
-    def bulk_insert(cls, documents):
-        if not documents:
-            return
-        if hasattr(cls.objects, 'bulk_create'):  # added in Django 1.4
-            cls.objects.bulk_create(documents)
+    def _documents_close(cls, qset, delete_time, returning):
+        '''
+        Close the current versions in **qset**, return the number of them
+        or their document_ids if **returning**
+        '''
+        if not returning and not cls.document_changelog:
+            return qset.update(document_end=delete_time)
+        if 'postgresql' in _engine():
+            sql, params = qset.values('id').query\
+                    .get_compiler(DEFAULT_DB_ALIAS).as_sql()
+            cursor = connection.cursor()
+            cursor.execute('UPDATE %s SET document_end = %%s '
+                           'WHERE id IN (%s) AND document_end > %%s '
+                           'RETURNING document_id'
+                           % (connection.ops.quote_name(
+                                   cls.id_model()._meta.db_table), sql),
+                           (delete_time,) + tuple(params) + (FUTURE,))
+            document_ids = [int(r[0]) for r in cursor]
+            cursor.close()
+            transaction.commit_unless_managed()
         else:
-            cls._bulk_insert_custom(documents)
+            rows = list(qset.values_list('id', 'document_id'))
+            document_ids = [document_id for _, document_id in rows]
+            if rows:
+                cls.objects.filter(id__in=[id_ for id_, _ in rows],
+                                   document_end__gt=FUTURE)\
+                        .update(document_end=delete_time)
+        cls.document_log(DocumentChange.DELETED,
+                         [(i, None) for i in document_ids], delete_time)
+        return document_ids if returning else len(document_ids)
 
     @classmethod
-    def _bulk_insert_custom(cls, documents):
-        qn = connection.ops.quote_name
-        cursor = connection.cursor()
-        fields = cls._meta.fields
-        flds = ', '.join(qn(f.column) for f in fields)
-        # sqlite INSERT can not process many values in one query
-        if 'sqlite' in settings.DATABASES[DEFAULT_DB_ALIAS]['ENGINE']:
-            values_list = [[f.get_db_prep_save(getattr(d, f.attname))
-                              for f in fields] for d in documents]
-            arg_string = '(' + ', '.join(['%s'] * len(fields)) + ')'
-            sql = 'INSERT INTO %s(%s) VALUES %s' \
-                    % (cls._meta.db_table, flds, arg_string)
-            cursor.executemany(sql, values_list)
-        else:
-            values_list = [f.get_db_prep_save(getattr(d, f.attname))
-                            for d in documents for f in fields]
-            arg_string = ', '.join(
-                    ['(' + ', '.join(['%s'] * len(fields)) + ')']
-                    * len(documents))
-            sql = 'INSERT INTO %s(%s) VALUES %s' \
-                    % (cls._meta.db_table, flds, arg_string)
-            cursor.execute(sql, values_list)
-        cursor.close()
-        transaction.commit_unless_managed()
+    def document_log(cls, kind, changes, time):
+        '''
+        Write **changes** - (document_id, version id) pairs - of given
+        **kind** to DocumentChange, if document_changelog is set.
+
+        Call the saving methods in a transaction (e.g. commit_on_success)
+        to write the versions and the log atomically.
+        '''
+        if cls.document_changelog and changes:
+            DocumentChange.log(cls, kind, changes, time)
+
+    @classmethod
+    def bulk_delete_now(cls, documents):
+        return cls.bulk_documents_delete(documents, now())
 
     @classmethod
     def to_master(cls):
@@ -329,6 +1182,394 @@ class Document(DocumentPart):
         assert False, 'to_master of the main document should not be called'
 
 
+# the number of documents compared by one query in changed_documents
+HASH_CHUNK = 10000
+
+
+class HashedDocument(Document):
+    '''
+    Document, that keeps the digest of its data in **document_hash**.
+
+    The digest is updated by document_save and bulk_documents_save, and
+    lets compare the documents with their current versions without
+    loading them (see changed_documents), with one join on the index
+    (document_id, document_hash), that is created by syncdb (see
+    document_hash_index_sql).
+    '''
+
+    class Meta:
+        abstract = True
+
+    document_hash = models.CharField(
+            'Digest of the document data',
+            max_length=40, editable=False)
+
+    document_system_fields = Document.document_system_fields + (
+            'document_hash',)
+
+    def document_digest(self):
+        '''
+        SHA-1 hex digest of the data fields of the document
+        '''
+        h = hashlib.sha1()
+        for f in self.document_fields():
+            v = getattr(self, f.attname)
+            if v is None:
+                h.update('-')
+            else:
+                v = smart_str(v)
+                h.update('%d:%s' % (len(v), v))  # length-prefixed
+        return h.hexdigest()
+
+    def document_unchanged(self, current):
+        if self.id and self.id != current.id:
+            return False  # will fail with ChangedAlready
+        return self.document_digest() == current.document_hash
+
+    def document_save(self, *args, **kwargs):
+        self.document_hash = self.document_digest()
+        return super(HashedDocument, self).document_save(*args, **kwargs)
+
+    @classmethod
+    def bulk_documents_save(cls, documents, *args, **kwargs):
+        documents = list(documents)
+        for d in documents:
+            d.document_hash = d.document_digest()
+        return super(HashedDocument, cls).bulk_documents_save(
+                documents, *args, **kwargs)
+
+    @classmethod
+    def changed_documents(cls, digests):
+        '''
+        Identifiers of the documents, whose current versions differ from
+        the given ones (or do not exist).
+
+        :param digests: iterable of (document_id, document_digest()) pairs
+        '''
+        digests = list(digests)
+        changed = []
+        for i in range(0, len(digests), HASH_CHUNK):
+            chunk = digests[i:i + HASH_CHUNK]
+            if 'postgresql' in _engine():
+                qn = connection.ops.quote_name
+                cursor = connection.cursor()
+                sql = 'SELECT v.document_id ' \
+                      'FROM (VALUES %s) AS v(document_id, document_hash) ' \
+                      'LEFT JOIN %s AS t ON t.document_id = v.document_id ' \
+                      'AND t.document_hash = v.document_hash ' \
+                      'AND t.document_end > %%s WHERE t.%s IS NULL' \
+                      % (', '.join(['(%s, %s)'] * len(chunk)),
+                         qn(cls._meta.db_table), qn(cls._meta.pk.column))
+                cursor.execute(sql, [v for pair in chunk for v in pair] +
+                                    [FUTURE])
+                changed.extend(int(r[0]) for r in cursor)
+                cursor.close()
+            else:
+                current = dict(cls.objects.filter(
+                        document_id__in=[did for did, h in chunk],
+                        document_end__gt=FUTURE)\
+                        .values_list('document_id', 'document_hash'))
+                changed.extend(did for did, h in chunk
+                               if current.get(did) != h)
+        return changed
+
+    @classmethod
+    def document_hash_index(cls, connection=connection):
+        '''
+        Name of the index (document_id, document_hash) of the table
+        '''
+        return truncate_name('%s_document_hash' % cls._meta.db_table,
+                             connection.ops.max_name_length())
+
+    @classmethod
+    def document_hash_index_sql(cls, connection=connection):
+        '''
+        SQL creating the index (document_id, document_hash) of the table
+        '''
+        qn = connection.ops.quote_name
+        return 'CREATE INDEX %s ON %s (%s, %s)' % (
+                qn(cls.document_hash_index(connection)),
+                qn(cls._meta.db_table),
+                qn(cls._meta.get_field('document_id').column),
+                qn(cls._meta.get_field('document_hash').column))
+
+
+def _index_exists(connection, name):
+    engine = connection.settings_dict['ENGINE']
+    if 'postgresql' in engine:
+        sql = "SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'i'"
+    elif 'sqlite' in engine:
+        sql = "SELECT 1 FROM sqlite_master WHERE name = %s AND type = 'index'"
+    else:
+        sql = 'SELECT 1 FROM information_schema.statistics ' \
+              'WHERE table_schema = DATABASE() AND index_name = %s'
+    cursor = connection.cursor()
+    cursor.execute(sql, [name])
+    return cursor.fetchone() is not None
+
+
+def create_hash_indexes(sender, created_models, db=DEFAULT_DB_ALIAS,
+                        **kwargs):
+    '''
+    post_syncdb handler, that creates the index (document_id,
+    document_hash) for the tables of HashedDocument subclasses
+    '''
+    # the signal is sent for each application (**sender**) with all
+    # created models (all models after flush), the fields of children
+    # are in the parent table
+    connection = connections[db]
+    hashed = [m for m in get_models(sender) if m in created_models and
+              issubclass(m, HashedDocument) and not m._meta.parents and
+              not _index_exists(connection, m.document_hash_index(connection))]
+    if not hashed:
+        return
+    cursor = connection.cursor()
+    for m in hashed:
+        cursor.execute(m.document_hash_index_sql(connection))
+    transaction.commit_unless_managed(using=db)
+
+post_syncdb.connect(create_hash_indexes)
+
+
+# the number of versions restored by one query in DeltaQuerySet
+DELTA_CHUNK = 100
+
+
+class DeltaQuerySet(models.query.QuerySet):
+    '''
+    QuerySet for DeltaDocument, that restores delta-encoded versions
+    '''
+
+    def iterator(self):
+        chunk = []
+        for d in super(DeltaQuerySet, self).iterator():
+            chunk.append(d)
+            if len(chunk) >= DELTA_CHUNK:
+                self.model.delta_restore(chunk)
+                for d in chunk:
+                    yield d
+                chunk = []
+        self.model.delta_restore(chunk)
+        for d in chunk:
+            yield d
+
+    def delete(self):
+        # the deleted versions are not restored (their chains could be
+        # broken already)
+        return self._clone(klass=models.query.QuerySet).delete()
+    delete.alters_data = True
+
+
+class DeltaManager(models.Manager):
+    def get_query_set(self):
+        return DeltaQuerySet(self.model, using=self._db)
+
+
+class DeltaNowManager(DocumentNowManager, DeltaManager):
+    pass
+
+
+class DeltaDocument(Document):
+    '''
+    Document, that stores fields from **delta_fields** (large text fields)
+    only in every **delta_snapshot_every**-th version. Other versions
+    keep default values in these columns, and changes from the previous
+    version in **document_delta**.
+
+    Versions are restored transparently by **objects** and **now**
+    managers (so in **at**, **history** and **document_get** too),
+    but not by values() and values_list().
+    '''
+
+    class Meta:
+        abstract = True
+
+    document_delta = models.TextField(
+            'Changes from the previous version',
+            editable=False, null=True)
+
+    delta_fields = ()
+    delta_snapshot_every = 16
+
+    document_system_fields = Document.document_system_fields + (
+            'document_delta',)
+
+    class DeltaChainBroken(Exception):
+        pass
+
+    objects = DeltaManager()    # restores delta-encoded versions
+    now = DeltaNowManager()     # at current time
+
+    @classmethod
+    def at_tuples(cls, dt, fields, blocksize=None, **kwargs):
+        fields = list(fields)
+        if not set(fields) & set(cls.delta_fields):
+            return super(DeltaDocument, cls).at_tuples(
+                    dt, fields, blocksize, **kwargs)
+        # delta fields are restored only in model instances
+        return (tuple(reduce(getattr, f.split('__'), d) for f in fields)
+                for d in cls.at(dt, **kwargs).iterator())
+
+    def history_records(self, fields=None, **kwargs):
+        fields = self._record_fields(fields)
+        if not set(fields) & set(self.delta_fields):
+            return super(DeltaDocument, self).history_records(
+                    fields, **kwargs)
+        record = record_type(self.__class__, fields)
+        attnames = [self._meta.get_field(f).attname for f in fields]
+        return (record._make(getattr(d, a) for a in attnames)
+                for d in self.history(**kwargs).iterator())
+
+    @classmethod
+    def delta_restore(cls, documents):
+        '''
+        Restore delta fields of delta-encoded **documents** (in place),
+        using one query for all of them.
+        '''
+        deltas = [(d, json.loads(d.document_delta)) for d in documents
+                  if d.document_delta is not None]
+        if not deltas:
+            return
+        fields = [cls._meta.get_field(n) for n in cls.delta_fields]
+        q = reduce(operator.or_, [
+                models.Q(document_id=d.document_id,
+                         id__range=(delta['base'], d.id - 1))
+                for d, delta in deltas])
+        rows = {}
+        for r in models.query.QuerySet(cls).filter(q)\
+                .order_by('id')\
+                .values_list('document_id', 'id', 'document_delta',
+                             *[f.attname for f in fields]):
+            rows.setdefault(r[0], []).append(r[1:])
+        for d, delta in deltas:
+            chain = [r for r in rows.get(d.document_id, [])
+                     if delta['base'] <= r[0] < d.id]
+            # the base snapshot and all deltas up to this version
+            if len(chain) != delta['depth'] or chain[0][0] != delta['base'] \
+                    or chain[0][1] is not None:
+                raise cls.DeltaChainBroken(
+                        '%s: document_id %d, id %d - versions of the delta '
+                        'chain from %d are missing (see delta_materialize)'
+                        % (cls.__name__, d.document_id, d.id, delta['base']))
+            values = {}
+            for id_, changes, vs in ((r[0], r[1], r[2:]) for r in chain):
+                if changes is None:
+                    values = dict(zip(cls.delta_fields, vs))
+                else:
+                    values.update(json.loads(changes)['fields'])
+            values.update(delta['fields'])
+            for f in fields:
+                setattr(d, f.attname, f.to_python(values[f.name]))
+
+    @classmethod
+    def delta_materialize(cls, qset=None):
+        '''
+        Store delta-encoded versions from **qset** (all by default) as
+        snapshots, so they do not depend on other versions. Call it for
+        the remaining versions before deleting versions of documents.
+        Return the number of converted versions.
+        '''
+        if qset is None:
+            qset = cls.objects.all()
+        ids = list(qset.filter(document_delta__isnull=False)
+                   .order_by('id').values_list('id', flat=True))
+        fields = [cls._meta.get_field(n) for n in cls.delta_fields]
+        for i in range(0, len(ids), DELTA_CHUNK):
+            # restored before the update of any of them
+            for d in list(cls.objects.filter(id__in=ids[i:i + DELTA_CHUNK])):
+                values = dict((f.attname, getattr(d, f.attname))
+                              for f in fields)
+                models.query.QuerySet(cls).filter(id=d.id)\
+                        .update(document_delta=None, **values)
+        return len(ids)
+
+    def delta_encode(self, previous):
+        '''
+        Return **document_delta** for this version, if it is stored
+        as the changes from the **previous** one, or None for a snapshot.
+        '''
+        if previous is None or previous.id is None:
+            return None
+        if previous.document_delta is None:
+            base, depth = previous.id, 1
+        else:
+            delta = json.loads(previous.document_delta)
+            base, depth = delta['base'], delta['depth'] + 1
+        if depth >= self.delta_snapshot_every:
+            return None
+        changes = {}
+        for n in self.delta_fields:
+            f = self._meta.get_field(n)
+            if getattr(self, f.attname) != getattr(previous, f.attname):
+                changes[n] = getattr(self, f.attname)
+        return json.dumps({'base': base, 'depth': depth, 'fields': changes})
+
+    def _delta_clear(self):
+        '''
+        Replace delta fields with defaults if this version is delta-encoded,
+        return the old values.
+        '''
+        values = {}
+        if self.document_delta is not None:
+            for n in self.delta_fields:
+                f = self._meta.get_field(n)
+                values[f.attname] = getattr(self, f.attname)
+                setattr(self, f.attname, f.get_default())
+        return values
+
+    def _delta_set(self, values):
+        for attname, value in values.items():
+            setattr(self, attname, value)
+
+    def save(self, *args, **kwargs):
+        if kwargs.get('force_insert'):
+            previous = None
+            if self.document_id:
+                try:
+                    previous = self.__class__.objects\
+                            .filter(document_id=self.document_id)\
+                            .order_by('-id')[0]
+                except IndexError:
+                    pass
+            self.document_delta = self.delta_encode(previous)
+        values = self._delta_clear()
+        try:
+            super(DeltaDocument, self).save(*args, **kwargs)
+        finally:
+            self._delta_set(values)
+
+    @classmethod
+    def _restore_copy(cls, dt, document_start, chunk):
+        # copies of delta-encoded rows would refer to wrong bases,
+        # so the versions are restored and saved again
+        qset = cls.at(dt, document_end__lte=FUTURE)
+        if chunk is not None:
+            qset = qset.filter(document_id__in=chunk)
+        documents = list(qset)
+        for d in documents:
+            d.id = None
+        cls._bulk_documents_save(documents, document_start, False, None)
+        return [d.document_id for d in documents]
+
+    @classmethod
+    def bulk_insert(cls, documents):
+        if not documents:
+            return
+        # previous versions were closed at the start of the new ones
+        previous = dict((d.document_id, d) for d in cls.objects.filter(
+                document_id__in=[d.document_id for d in documents],
+                document_end=documents[0].document_start))
+        values = []
+        for d in documents:
+            d.document_delta = d.delta_encode(previous.get(d.document_id))
+            values.append(d._delta_clear())
+        try:
+            super(DeltaDocument, cls).bulk_insert(documents)
+        finally:
+            for d, v in zip(documents, values):
+                d._delta_set(v)
+
+
 class DocumentPartF(DocumentPart):
     '''
     A part of the versioned document, that has links TO it::
@@ -385,3 +1626,126 @@ class DocumentPartB(DocumentPart):
                 return d.name
             return d.name + '__' + d.related.parent_model.to_master()
         raise cls.ConfigurationError('Master not found - redefine')
+
+
+class DocumentChange(models.Model):
+    '''
+    Log of changes of documents with **document_changelog** set: new
+    versions (SAVED, they close the previous ones) and deletions.
+    Consumers read it with **since**.
+
+    Ids are assigned at insert, not at commit, so on PostgreSQL the
+    entries also keep the transaction (txid_current()) and are read in
+    the order of (txid, id), only from the transactions older than all
+    running ones. Each change is read once, the changes of a transaction
+    together, but the transactions are ordered by their start, not by
+    commit. Other databases (sqlite) serialize writes, there txid is 0
+    and the order is the order of id.
+    '''
+
+    SAVED, DELETED = 'saved', 'deleted'
+
+    model = models.CharField('Model (app_label.ModelName)', max_length=100)
+    kind = models.CharField('Kind of the change', max_length=10)
+    document_id = models.IntegerField('Document identifier')
+    version_id = models.IntegerField(
+            'Identifier of the new version', null=True)
+    time = models.DateTimeField('Time of the change')
+    txid = models.BigIntegerField('Transaction', default=0)
+
+    @staticmethod
+    def model_name(model):
+        return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+    @classmethod
+    def log(cls, model, kind, changes, time):
+        '''
+        Write the entries for the (document_id, version_id) **changes**
+        with one statement (on PostgreSQL with the txid of the statement,
+        so the entries are not committed separately under an older txid)
+        '''
+        name = cls.model_name(model)
+        if 'postgresql' in _engine():
+            qn = connection.ops.quote_name
+            columns = ('model', 'kind', 'document_id', 'version_id', 'time')
+            sql = 'INSERT INTO %s (%s, %s) VALUES %s' % (
+                    qn(cls._meta.db_table),
+                    ', '.join(qn(cls._meta.get_field(c).column)
+                              for c in columns),
+                    qn(cls._meta.get_field('txid').column),
+                    ', '.join(['(%s, %s, %s, %s, %s, txid_current())']
+                              * len(changes)))
+            time = connection.ops.value_to_db_datetime(time)
+            params = []
+            for document_id, version_id in changes:
+                params += [name, kind, document_id, version_id, time]
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            cursor.close()
+            transaction.commit_unless_managed()
+            return
+        entries = [cls(model=name, kind=kind, document_id=document_id,
+                       version_id=version_id, time=time)
+                   for document_id, version_id in changes]
+        if hasattr(cls.objects, 'bulk_create'):  # added in Django 1.4
+            cls.objects.bulk_create(entries)
+        elif transaction.is_managed():
+            for e in entries:
+                e.save()
+        else:
+            with transaction.commit_on_success():
+                for e in entries:
+                    e.save()
+
+    @classmethod
+    def since(cls, cursor, limit=1000, models=None):
+        '''
+        Changes after the position of the **cursor** (DocumentChangeCursor
+        name) in the order of (txid, id), at most **limit** of them. Does
+        not move the cursor, see **DocumentChangeCursor.advance**.
+
+        :param models: if given, only changes of these models are returned
+        '''
+        txid, position = DocumentChangeCursor.position_of(cursor)
+        qset = cls.objects.filter(
+                Q(txid__gt=txid) | Q(txid=txid, id__gt=position))
+        if 'postgresql' in _engine():
+            # the transactions, that can not get new entries
+            qset = qset.extra(where=[
+                    'txid < txid_snapshot_xmin(txid_current_snapshot())'])
+        if models is not None:
+            qset = qset.filter(model__in=[cls.model_name(m) for m in models])
+        return list(qset.order_by('txid', 'id')[:limit])
+
+
+class DocumentChangeCursor(models.Model):
+    '''
+    Position of a consumer in DocumentChange (the last change read)
+    '''
+
+    name = models.CharField('Consumer name', max_length=100, unique=True)
+    txid = models.BigIntegerField('Transaction of the last change read',
+                                  default=0)
+    position = models.IntegerField('Last change read', default=0)
+
+    @classmethod
+    def position_of(cls, name):
+        '''
+        (txid, id) of the last change read by the consumer **name**
+        '''
+        try:
+            c = cls.objects.get(name=name)
+        except cls.DoesNotExist:
+            return 0, 0
+        return c.txid, c.position
+
+    @classmethod
+    def advance(cls, name, change):
+        '''
+        Move the cursor **name** to the **change** (DocumentChange, the
+        last processed one).
+        '''
+        if not cls.objects.filter(name=name).update(
+                txid=change.txid, position=change.id):
+            cls.objects.create(name=name, txid=change.txid,
+                               position=change.id)
@@ -0,0 +1,126 @@
+# -*- encoding: utf-8 -*-
+
+import threading
+try:
+    from Queue import Queue
+except ImportError:  # python 3
+    from queue import Queue
+
+from django.conf import settings
+from django.db import transaction, connection
+
+from documents.retrospection import get_or_create_now
+
+
+'''
+Pool of threads for background reads of documents
+'''
+
+
+WORKERS = getattr(settings, 'DOCUMENTS_READ_WORKERS', 4)
+
+
+class ReadResult(object):
+    '''
+    Result of a call in ReadPool
+    '''
+
+    class Timeout(Exception):
+        pass
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._value = self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''
+        Wait for the call and return its result (or raise its exception)
+        '''
+        if not self._done.wait(timeout):
+            raise self.Timeout()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def add_done_callback(self, f):
+        '''
+        Call f(result) when the call is done: in the worker thread, or
+        at once, if it is done already
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(f)
+                return
+        f(self)
+
+    def _set(self, value, error):
+        with self._lock:
+            self._value, self._error = value, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for f in callbacks:
+            f(self)
+
+
+class ReadPool(object):
+    '''
+    Pool of **workers** threads, that run reads of documents in the
+    background (each thread has its own database connection), with the
+    current time (see retrospection.now) of the calling code.
+
+    The package targets Python 2 and the Django versions, that do not
+    run on asyncio, so the pool is based on threads. Code with an event
+    loop can pass the results to it with **add_done_callback** and
+    loop.call_soon_threadsafe. The calls should return evaluated
+    results (lists, not QuerySets).
+    '''
+
+    def __init__(self, workers=WORKERS):
+        self._queue = Queue()
+        self._threads = [threading.Thread(target=self._run)
+                         for i in range(workers)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def run(self, f, *args, **kwargs):
+        '''
+        Call **f** in the pool, return ReadResult
+        '''
+        result = ReadResult()
+        dt = getattr(get_or_create_now(), 'dt', None)
+        self._queue.put((result, dt, f, args, kwargs))
+        return result
+
+    def close(self):
+        '''
+        Stop the threads after the queued calls
+        '''
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+    def _run(self):
+        try:
+            while True:
+                task = self._queue.get()
+                if task is None:
+                    return
+                result, dt, f, args, kwargs = task
+                get_or_create_now().dt = dt
+                try:
+                    value, error = f(*args, **kwargs), None
+                except Exception as e:
+                    value, error = None, e
+                finally:
+                    get_or_create_now().dt = None
+                    transaction.commit_unless_managed()  # end the snapshot
+                result._set(value, error)
+        finally:
+            connection.close()
@@ -0,0 +1,70 @@
+# -*- encoding: utf-8 -*-
+
+from collections import OrderedDict
+from itertools import count
+
+from django.conf import settings
+from django.db import connection
+
+
+'''
+Cache of prepared statements (PostgreSQL PREPARE / EXECUTE) for the
+frequent queries of documents, see Document.document_prepared
+
+The statements live as long as the database connection. Django closes
+the connection at the end of each request, so inside web requests the
+first query of each kind costs PREPARE and EXECUTE, that is slower than
+the plain query. Use it for long-lived connections (batch jobs, workers).
+'''
+
+
+# the maximum number of statements prepared on one connection
+PREPARED_MAX = getattr(settings, 'DOCUMENTS_PREPARED_MAX', 100)
+
+# hits, misses and evictions of the cache (for all connections)
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+_names = count(1)
+
+
+def reset_stats():
+    for k in stats:
+        stats[k] = 0
+
+
+def _prepared():
+    '''
+    Return the OrderedDict (sql -> statement name) of the statements
+    prepared on the current database connection (least recent first).
+    '''
+    raw = connection.connection
+    cache = getattr(connection, '_documents_prepared', None)
+    if cache is None or cache[0] is not raw:  # reconnected
+        cache = (raw, OrderedDict())
+        connection._documents_prepared = cache
+    return cache[1]
+
+
+def execute(sql, params):
+    '''
+    Execute **sql** (with %s placeholders) as a prepared statement,
+    preparing it on first use on this connection. Return the cursor.
+    '''
+    cursor = connection.cursor()
+    prepared = _prepared()
+    name = prepared.pop(sql, None)
+    if name is None:
+        stats['misses'] += 1
+        if len(prepared) >= PREPARED_MAX:
+            _, old = prepared.popitem(last=False)
+            cursor.execute('DEALLOCATE %s' % old)
+            stats['evictions'] += 1
+        name = 'documents_%d' % next(_names)
+        cursor.execute('PREPARE %s AS %s' % (name, sql % tuple(
+                '$%d' % (i + 1) for i in range(len(params)))))
+    else:
+        stats['hits'] += 1
+    prepared[sql] = name
+    cursor.execute('EXECUTE %s (%s)'
+                   % (name, ', '.join(['%s'] * len(params))), params)
+    return cursor
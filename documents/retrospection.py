@@ -5,9 +5,15 @@ from contextlib import contextmanager
 from functools import wraps
 import threading
 
+try:
+    from contextvars import ContextVar
+except ImportError:  # python < 3.7
+    ContextVar = None
+
 from django.http import HttpResponseRedirect
 from django.contrib import messages
 from django.conf import settings
+from django.db import transaction, connections, DEFAULT_DB_ALIAS
 
 
 ''' 
@@ -19,48 +25,100 @@ at some time in the past
 NOW_FIELD = 'RETROSPECTION_DATETIME'
 DATETIME_FORMAT = getattr(settings, 'DATETIME_FORMAT', '%Y-%m-%d %H:%M:%S')
 DJANGO_DATETIME_FORMAT = getattr(settings, 'DJANGO_DATETIME_FORMAT', "Y-m-d H:i:s")
+RETROSPECTION_COOKIE = getattr(settings, 'RETROSPECTION_COOKIE', 'retrospection')
+# run retrospective requests in one transaction, see snapshot_transaction
+RETROSPECTION_SNAPSHOT = getattr(settings, 'RETROSPECTION_SNAPSHOT', False)
+
+
+class _ThreadLocalVar(threading.local):
+    '''
+    Replacement of ContextVar for python < 3.7
+    '''
+    value = None
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+# current time of the thread (or asyncio task, or context), and
+# whether it was set by the user (retrospection mode)
+if ContextVar is not None:
+    _now = ContextVar(NOW_FIELD, default=None)
+    _retrospection = ContextVar('RETROSPECTION', default=False)
+else:
+    _now = _ThreadLocalVar()
+    _retrospection = _ThreadLocalVar()
+
+
+class _Now(object):
+    '''
+    Current time in "dt" attribute, for compatibility
+    '''
+
+    @property
+    def dt(self):
+        return _now.get()
+
+    @dt.setter
+    def dt(self, value):
+        _now.set(value)
+
+
+_now_obj = _Now()
 
 
 def get_or_create_now():
     ''' 
-    Return the thread-local object, that stores current time 
-    in its "dt" attribute.
+    Return the object, that stores current time in its "dt" attribute.
     '''
-    if not hasattr(settings, NOW_FIELD):
-        setattr(settings, NOW_FIELD, threading.local())
-    return getattr(settings, NOW_FIELD)
+    return _now_obj
 
 
 def now(request=None):
     '''
-    Return the time set in given request (or in current thread, if request 
-    is not given). If there is no current time set in the thread, this
+    Return the time set in given request (or in current context, if request 
+    is not given). If there is no current time set in the context, this
     time is set. Successive calls will return the same time till the end
     of this request, or till a new time will be set by **set_now** call.
     '''
-    dt = getattr(get_or_create_now(), 'dt', None)
-    if request is not None:
-        dt = request.session.get(NOW_FIELD)
-        if dt:
-            try: return datetime.strptime(dt, DATETIME_FORMAT)
+    dt = _now.get()
+    if request is not None and hasattr(request, 'retrospection_dt'):
+        if request.retrospection_dt is not None:
+            return request.retrospection_dt
+    elif request is not None:
+        rdt = request.session.get(NOW_FIELD)
+        if rdt:
+            try: return datetime.strptime(rdt, DATETIME_FORMAT)
             except ValueError: pass
     if dt is None:
         dt = datetime.now()
-        setattr(get_or_create_now(), 'dt', dt)
+        _now.set(dt)
     return dt
 
 
+def in_retrospection():
+    '''
+    True if the current time is set by the user (by RetrospectionMiddleware)
+    '''
+    return bool(_retrospection.get())
+
+
 def set_now(dt=None):
     '''
-    Set new time for the thread to given **dt**, or to **datetime.now**, 
+    Set new time for the context to given **dt**, or to **datetime.now**, 
     if no argument is given.
     '''
-    setattr(get_or_create_now(), 'dt', dt or datetime.now())
+    _now.set(dt or datetime.now())
 
 
 class RetrospectionMiddleware(object):
     exit_param = 'exit_retrospection'
     enter_param = 'enter_retrospection'
+    cookie_name = RETROSPECTION_COOKIE
+    use_snapshot = RETROSPECTION_SNAPSHOT
 
     def process_request(self, request):
         ''' 
@@ -75,40 +133,80 @@ class RetrospectionMiddleware(object):
         To make a POST request in retrospection, pass "post_in_retrospection"
         in request.POST.
 
+        The session is read only for requests with the retrospection cookie
+        (set on entering retrospection mode, with the expiry of the
+        session), so other requests do not load it. The time set by the
+        user is stored in **request.retrospection_dt** (None if not in
+        retrospection mode).
+
+        If **settings.RETROSPECTION_SNAPSHOT** is True, retrospective
+        requests are processed in one read only transaction (see
+        **snapshot_transaction**) on **settings.RETROSPECTION_DATABASE**
+        (if set) or the default database.
+
         Include this middleware in **settings.MIDDLEWARE_CLASSES** after the
         django **SessionMiddleware**.
         '''
+        request.retrospection_dt = None
+        if self.cookie_name not in request.COOKIES and \
+                self.enter_param not in request.GET:
+            return
         dt = request.session.get(NOW_FIELD)
-        now_obj = get_or_create_now()
-        if dt: # we are in retrospection mode
-            if request.method == 'POST' and \
-                    not 'post_in_retrospection' in request.POST:
-                messages.error(request, u'Retrospection mode is read-only')
-                return HttpResponseRedirect(request.META['PATH_INFO'])
-            if self.exit_param in request.GET:
-                exit_retrospection(request)
-                now_obj.dt = None
-            else:
-                try:
-                    now_obj.dt = datetime.strptime(dt, DATETIME_FORMAT)
-                except ValueError:
-                    now_obj.dt = None
+        if dt and request.method == 'POST' and \
+                not 'post_in_retrospection' in request.POST:
+            messages.error(request, u'Retrospection mode is read-only')
+            return HttpResponseRedirect(request.META['PATH_INFO'])
+        if dt and self.exit_param in request.GET:
+            exit_retrospection(request)
+            _now.set(None)
         elif self.enter_param in request.GET:
-            # enter retrospection mode
+            # enter retrospection mode (or change its time)
             dt = request.GET[self.enter_param]
             try:
                 dt = datetime.strptime(dt, DATETIME_FORMAT)
             except ValueError:
                 dt = datetime.now()
             request.session[NOW_FIELD] = dt.strftime(DATETIME_FORMAT)
-            now_obj.dt = dt
+            request.retrospection_dt = dt
+            request.retrospection_cookie = True
+            _now.set(dt)
+            _retrospection.set(True)
+        elif dt: # we are in retrospection mode
+            try:
+                dt = datetime.strptime(dt, DATETIME_FORMAT)
+            except ValueError:
+                dt = None
+            request.retrospection_dt = dt
+            request.retrospection_cookie = dt is not None  # renew
+            _now.set(dt)
+            _retrospection.set(dt is not None)
+            if dt is not None and self.use_snapshot:
+                request.retrospection_snapshot = snapshot_transaction(
+                    getattr(settings, 'RETROSPECTION_DATABASE', None))
+                request.retrospection_snapshot.__enter__()
+        else: # the session has expired or was changed elsewhere
+            request.retrospection_cookie = False
 
     def process_response(self, request, response):
         ''' 
         After we are done with request processing, 
-        remove variable with current time.
+        remove variable with current time, and set or delete the
+        retrospection cookie.
         '''
-        get_or_create_now().dt = None
+        _now.set(None)
+        _retrospection.set(False)
+        if getattr(request, 'retrospection_snapshot', None) is not None:
+            request.retrospection_snapshot.__exit__(None, None, None)
+            request.retrospection_snapshot = None
+        cookie = getattr(request, 'retrospection_cookie', None)
+        if cookie is True:
+            # expires with the session, that keeps the time
+            session = request.session
+            response.set_cookie(self.cookie_name, '1', max_age=None
+                    if session.get_expire_at_browser_close()
+                    else session.get_expiry_age())
+        elif cookie is False:
+            response.delete_cookie(self.cookie_name)
         return response
 
 
@@ -116,6 +214,9 @@ def retrospection_context_processor(request):
     ''' 
     Add retrospection_dt to template context, if we are in retrospection mode
     '''
+    if hasattr(request, 'retrospection_dt'):  # set by the middleware
+        dt = request.retrospection_dt
+        return {'retrospection_dt': dt} if dt else {}
     dt = request.session.get(NOW_FIELD)
     if dt:
         return {'retrospection_dt': datetime.strptime(dt, DATETIME_FORMAT)}
@@ -127,17 +228,57 @@ def exit_retrospection(request):
     Exit retrospection mode by removing the NOW_FIELD from user session
     '''
     del request.session[NOW_FIELD]
+    request.retrospection_dt = None
+    request.retrospection_cookie = False
+
+
+@contextmanager
+def snapshot_transaction(using=None):
+    '''
+    A context manager, that runs the block in one read only transaction,
+    REPEATABLE READ on PostgreSQL, so all queries see the same state of
+    the database. The transaction is rolled back at the end.
+
+    Does nothing if the transaction is managed already.
+    '''
+    using = using or DEFAULT_DB_ALIAS
+    if transaction.is_managed(using=using):
+        yield
+        return
+    transaction.enter_transaction_management(using=using)
+    transaction.managed(True, using=using)
+    try:
+        connection = connections[using]
+        # opening the connection runs queries (SET TIME ZONE...), so the
+        # cursor is taken before the commit, that starts a new transaction
+        cursor = connection.cursor()
+        transaction.commit(using=using)
+        if 'postgresql' in connection.settings_dict['ENGINE']:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL '
+                           'REPEATABLE READ, READ ONLY')
+        yield
+    finally:
+        transaction.rollback(using=using)
+        transaction.leave_transaction_management(using=using)
 
 
 @contextmanager
-def current_time(dt=None):
+def current_time(dt=None, snapshot=False, using=None):
     '''
     A context manager to set current time to given value 
     (datetime.now() by default).
+
+    :param snapshot: if True, run the block in one read only transaction
+        on the database **using** (see **snapshot_transaction**)
     '''
     old = now()
     set_now(dt)
-    try: yield
+    try:
+        if snapshot:
+            with snapshot_transaction(using):
+                yield
+        else:
+            yield
     finally: set_now(old)
 
 
@@ -0,0 +1,38 @@
+# -*- encoding: utf-8 -*-
+
+from django.conf import settings
+
+from documents.retrospection import in_retrospection
+
+
+class RetrospectionRouter(object):
+    '''
+    Database router, that sends reads of documents and their parts
+    (DocumentPart subclasses) in retrospection mode to the database
+    **settings.RETROSPECTION_DATABASE** (a read replica or a snapshot),
+    as the retrospection mode is read only.
+
+    Include this router in **settings.DATABASE_ROUTERS** and
+    **RetrospectionMiddleware** in **settings.MIDDLEWARE_CLASSES**.
+    '''
+
+    def __init__(self):
+        self.database = getattr(settings, 'RETROSPECTION_DATABASE', None)
+
+    def db_for_read(self, model, **hints):
+        # not at module level: django.db loads the routers before it
+        # defines the connection, that documents.models imports
+        from documents.models import DocumentPart
+        if self.database and issubclass(model, DocumentPart) \
+                and in_retrospection():
+            return self.database
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_syncdb(self, db, model):
+        return None
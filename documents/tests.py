@@ -1,15 +1,35 @@
 # -*- encoding: utf-8 -*-
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal
 from time import sleep
+import os
+import subprocess
+import sys
+from threading import Thread, Event
+
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase
+from django.utils import unittest
+from django.http import Http404, HttpResponse
+from django.test.client import RequestFactory
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models.signals import post_save
+
+from documents.models import Document, DocumentPartF, DocumentPartB, \
+        FUTURE, DeltaDocument, HashedDocument, DocumentChange, DocumentChangeCursor
+from documents.retrospection import now, set_now, current_time, \
+        RetrospectionMiddleware, retrospection_context_processor, \
+        NOW_FIELD, DATETIME_FORMAT
+from documents.fields import DocumentForeignKey
+from documents.buffered import BufferedWriter
+from documents.routers import RetrospectionRouter
+from documents.intervals import IntervalIndex
+from documents import prepared, retrospection
+from documents.pool import ReadPool
 
-from django.test import TestCase
-from django.http import Http404
-from django.db import models
 
-from documents.models import Document, DocumentPartF, DocumentPartB
-from documents.retrospection import now, set_now
-from documents.fields import DocumentForeignKey
+POSTGRESQL = 'postgresql' in settings.DATABASES['default']['ENGINE']
 
 
 # models for doc-test of modified example from django tutorial
@@ -398,6 +418,64 @@ class DocumentFKSource(Document):
     link = DocumentForeignKey(DocumentFKDestination)
 
 
+class DeltaTextDocument(DeltaDocument):
+    data = models.IntegerField()
+    text = models.TextField()
+
+    delta_fields = ('text',)
+    delta_snapshot_every = 3
+
+
+class HashedSimpleDocument(HashedDocument):
+    data = models.IntegerField()
+
+
+class HashedPairDocument(HashedDocument):
+    first = models.CharField(max_length=10, null=True)
+    second = models.CharField(max_length=10, null=True)
+
+
+class ReturningDocument(Document):
+    data = models.IntegerField()
+
+    document_save_returning = True
+
+
+class ReturningNumberedDocument(Document):
+    data = models.IntegerField()
+
+    document_save_returning = True
+
+    def new_document_id(self):
+        return self.id + 1000
+
+
+class LockedDocument(Document):
+    data = models.IntegerField()
+
+    document_advisory_lock = True
+
+
+class PreparedDocument(Document):
+    data = models.IntegerField()
+
+    document_prepared = True
+
+
+class FlatDocument(Document):
+    data = models.IntegerField()
+
+
+class PricedDocument(Document):
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+
+
+class LoggedDocument(Document):
+    data = models.IntegerField()
+
+    document_changelog = True
+
+
 __test__ = {
     'polltest': polltest,
     'polltest2': polltest2,
@@ -425,6 +503,32 @@ class SimpleDocumentBulkTest(TestCase):
             self.assertRaises(SimpleDocument.DoesNotExist,
                     SimpleDocument.now.get, data=data)
 
+    def test_bulk_delete_chunks(self):
+        import documents.models
+        docs = [SimpleDocument(data=i) for i in range(5)]
+        SimpleDocument.bulk_documents_save(docs)
+        docs[0].document_delete()
+        chunk = documents.models.DELETE_CHUNK
+        documents.models.DELETE_CHUNK = 2
+        try:
+            self.assertEqual(sorted(SimpleDocument.bulk_documents_delete(
+                    (d for d in docs[:4]), returning=True)),
+                    sorted(d.document_id for d in docs[1:4]))
+        finally:
+            documents.models.DELETE_CHUNK = chunk
+        self.assertEqual(SimpleDocument.bulk_documents_delete(docs), 1)
+        self.assertEqual(SimpleDocument.bulk_documents_delete([]), 0)
+
+    def test_bulk_delete_where(self):
+        docs = [SimpleDocument(data=i) for i in range(5)]
+        SimpleDocument.bulk_documents_save(docs)
+        self.assertEqual(SimpleDocument.bulk_documents_delete_where(
+                data__lt=2), 2)
+        self.assertEqual(SimpleDocument.bulk_documents_delete_where(
+                returning=True, data__in=[1, 2]), [docs[2].document_id])
+        self.assertEqual(sorted(SimpleDocument.at(datetime.now())
+                                .values_list('data', flat=True)), [3, 4])
+
     def test_document_save_many(self):
         d1 = SimpleDocument(data=1)
         d2 = SimpleDocument(data=2)
@@ -570,11 +674,212 @@ class SimpleDocumentBulkTest(TestCase):
         self.assertEqual(
                 SimpleDocument.at(datetime.now()).get(document_id=123).data, 2)
 
+    def test_conflicts(self):
+        d1 = SimpleDocument(data=1)
+        d2 = SimpleDocument(data=2)
+        SimpleDocument.bulk_documents_save([d1, d2])
+        stale = SimpleDocument.objects.get(id=d1.id)
+        d1.data = 3
+        d1.document_save()
+        stale.data = 4
+        d2.data = 5
+        d3 = SimpleDocument(data=6)
+        conflicts = []
+        SimpleDocument.bulk_documents_save(
+                [stale, d2, d3], conflicts=conflicts)
+        self.assertEqual(conflicts, [stale])
+        self.assertEqual(sorted(SimpleDocument.at(datetime.now())
+                .values_list('data', flat=True)), [3, 5, 6])
+
+    def test_skip_if_unchanged(self):
+        d1 = SimpleDocument(data=1)
+        d2 = SimpleDocument(data=2)
+        SimpleDocument.bulk_documents_save([d1, d2])
+        id1 = d1.id
+        d1 = SimpleDocument(data=1, document_id=d1.document_id)
+        d2.data = 3
+        d3 = SimpleDocument(data=4)
+        self.assertEqual(SimpleDocument.bulk_documents_save(
+                [d1, d2, d3], skip_if_unchanged=True), 1)
+        self.assertEqual(d1.id, id1)
+        self.assertEqual(SimpleDocument.objects.count(), 4)
+        self.assertEqual(sorted(SimpleDocument.at(datetime.now())
+                .values_list('data', flat=True)), [1, 3, 4])
+
+
+class AtValuesTest(TestCase):
+    def tearDown(self):
+        SimpleDocument.objects.all().delete()
+
+    def test_at_values(self):
+        SimpleDocument.bulk_documents_save(
+                [SimpleDocument(data=i) for i in range(5)])
+        t = datetime.now()
+        rows = list(SimpleDocument.at_values(t, ['data', 'document_id']))
+        self.assertEqual(sorted(r.data for r in rows), range(5))
+        self.assertEqual(rows[0]._fields, ('data', 'document_id'))
+        self.assertEqual(sorted(SimpleDocument.at_tuples(
+                t, ['data'], blocksize=2, data__gte=2)), [(2,), (3,), (4,)])
+
+
+class ChangesBetweenTest(TestCase):
+    def tearDown(self):
+        SimpleDocument.objects.all().delete()
+
+    def test_changes_between(self):
+        d1, d2, d3 = [SimpleDocument(data=i) for i in range(3)]
+        SimpleDocument.bulk_documents_save([d1, d2, d3])
+        sleep(0.001)
+        t1 = datetime.now()
+        sleep(0.001)
+        d1.data = 10
+        d4 = SimpleDocument(data=4)
+        d5 = SimpleDocument(data=5)
+        SimpleDocument.bulk_documents_save([d1, d4, d5])
+        d2.document_delete()
+        d5.document_delete()
+        sleep(0.001)
+        t2 = datetime.now()
+        self.assertEqual(list(SimpleDocument.changes_between(t1, t2)), [
+                (Document.UPDATED, d1.document_id, d1.id),
+                (Document.DELETED, d2.document_id, d2.id),
+                (Document.CREATED, d4.document_id, d4.id)])
+        self.assertEqual(list(SimpleDocument.changes_between(
+                t1, t2, blocksize=1,
+                document_id__in=[d2.document_id, d4.document_id])), [
+                (Document.DELETED, d2.document_id, d2.id),
+                (Document.CREATED, d4.document_id, d4.id)])
+
+
+class TimelineTest(TestCase):
+    def setUp(self):
+        self.t0 = t0 = datetime(2000, 1, 1)
+        self.day = day = timedelta(days=1)
+        self.d1 = d1 = SimpleDocument(data=1)
+        d1.document_save(t0)
+        d2 = SimpleDocument(data=10)
+        d2.document_save(t0 + day)
+        d1.data = 3
+        d1.document_save(t0 + 2 * day)
+        d2.document_delete(t0 + 3 * day)
+
+    def tearDown(self):
+        SimpleDocument.objects.all().delete()
+
+    def test_timeline_counts(self):
+        t0, day, d1 = self.t0, self.day, self.d1
+        self.assertEqual(SimpleDocument.timeline_counts(
+                t0 - day, t0 + 4 * day, day),
+                [(t0 + i * day, n) for i, n in
+                 zip(range(-1, 5), [0, 1, 2, 2, 1, 1])])
+        self.assertEqual(SimpleDocument.timeline_counts(
+                t0, t0 + 4 * day, 2 * day, document_id=d1.document_id),
+                [(t0, 1), (t0 + 2 * day, 1), (t0 + 4 * day, 1)])
+        self.assertRaises(AssertionError, SimpleDocument.timeline_counts,
+                          t0, t0 + day, timedelta(0))
+
+    def test_time_weighted(self):
+        t0, day, d1 = self.t0, self.day, self.d1
+        self.assertEqual(SimpleDocument.time_weighted(
+                'data', t0, t0 + 4 * day, document_id=d1.document_id), 2)
+        self.assertEqual(SimpleDocument.time_weighted(
+                'data', t0 + day, t0 + 3 * day), (1 + 3 + 2 * 10) / 4.)
+        self.assertEqual(SimpleDocument.time_weighted(
+                'data', t0 - 2 * day, t0 - day), None)
+        p = PricedDocument(price=Decimal('1.50'))
+        p.document_save(t0)
+        p.price = Decimal('2.50')
+        p.document_save(t0 + day)
+        self.assertEqual(PricedDocument.time_weighted(
+                'price', t0, t0 + 2 * day), 2)
+        PricedDocument.objects.all().delete()
+
+
+class IntervalIndexTest(TestCase):
+    def tearDown(self):
+        SimpleDocument.objects.all().delete()
+
+    def test_interval_index(self):
+        docs = [SimpleDocument(data=i) for i in range(5)]
+        SimpleDocument.bulk_documents_save(docs)
+        sleep(0.001)
+        t = datetime.now()
+        for d in docs:
+            d.data += 10
+        SimpleDocument.bulk_documents_save(docs[:3])
+        docs[4].document_delete()
+        index = IntervalIndex(SimpleDocument, blocksize=3, fetch_size=2)
+        self.assertEqual(len(index), 8)
+        for dt in (t, datetime.now()):
+            for d in docs:
+                try:
+                    expected = SimpleDocument.document_get(
+                            dt, document_id=d.document_id)
+                except SimpleDocument.DoesNotExist:
+                    self.assertRaises(SimpleDocument.DoesNotExist,
+                            index.document_get, dt, d.document_id)
+                else:
+                    self.assertEqual(
+                            index.document_get(dt, d.document_id).id,
+                            expected.id)
+        self.assertEqual([d and d.data for d in index.get_many(
+                [(t, docs[0].document_id), (datetime(2000, 1, 1), 1),
+                 (datetime.now(), 1000)])], [0, None, None])
+
 
 class SimpleDocumentTest(TestCase):
     def tearDown(self):
         SimpleDocument.objects.all().delete()
 
+    def test_document_save_one_write(self):
+        saved = []
+        def on_save(sender, instance, created, **kwargs):
+            saved.append(created)
+        post_save.connect(on_save, sender=SimpleDocument)
+        try:
+            d = SimpleDocument(data=1)
+            d.document_save()
+        finally:
+            post_save.disconnect(on_save, sender=SimpleDocument)
+        if 'postgresql' in settings.DATABASES['default']['ENGINE']:
+            self.assertEqual(saved, [True])
+        else:   # written, then updated with new_document_id
+            self.assertEqual(saved, [True, False])
+        self.assertEqual(d.document_id, d.id)
+        self.assertEqual(
+                SimpleDocument.objects.get(id=d.id).document_id, d.id)
+
+    def test_skip_if_unchanged(self):
+        d = SimpleDocument(data=1)
+        self.assertEqual(d.document_save(skip_if_unchanged=True), 0)
+        id1 = d.id
+        d = SimpleDocument(data=1, document_id=d.document_id)
+        self.assertEqual(d.document_save(skip_if_unchanged=True), 1)
+        self.assertEqual(d.id, id1)
+        d.data = 2
+        self.assertEqual(d.document_save(skip_if_unchanged=True), 0)
+        self.assertNotEqual(d.id, id1)
+        self.assertEqual(SimpleDocument.objects.count(), 2)
+
+    def test_history_records(self):
+        d = SimpleDocument(data=1)
+        d.document_save()
+        d.data = 2
+        d.document_save()
+        records = list(d.history_records())
+        self.assertEqual([r.data for r in records], [2, 1])
+        self.assertEqual(records[0].id, d.id)
+        self.assertRaises(AttributeError, setattr, records[0], 'data', 3)
+        instance = records[1].instance()
+        self.assertEqual(instance.__class__, SimpleDocument)
+        self.assertEqual(instance.data, 1)
+        instance.document_restore()
+        self.assertEqual(SimpleDocument.document_get(
+                datetime.now(), document_id=d.document_id).data, 1)
+        record, = d.history_records(['data'], data=2)
+        self.assertEqual(record._fields, ('data', 'id'))
+        self.assertEqual(record.instance().id, d.id)
+
     def test_document_save(self):
         d = SimpleDocument(data=1)
         d.document_save()
@@ -819,6 +1124,24 @@ class DocumentPartBTest(TestCase):
         self.assertEqual(BPart.document_get(inter).partdata, 1)
         self.assertEqual(BPart.document_get(after).partdata, 2)
 
+    def test_bulk_documents_save_with_parts(self):
+        documents = [DocumentB(data=i) for i in range(3)]
+        parts = [BPart(partdata=i * 10 + j, link=d)
+                 for i, d in enumerate(documents) for j in range(2)]
+        DocumentB.bulk_documents_save_with_parts(documents, parts)
+        d = documents[1]
+        self.assertEqual(sorted(BPart.at(datetime.now(), link__document_id=
+                d.document_id).values_list('partdata', flat=True)), [10, 11])
+        sleep(0.001)
+        inter = datetime.now()
+        d.data = 5
+        DocumentB.bulk_documents_save_with_parts(
+                [d], [BPart(partdata=12, link=d)])
+        self.assertEqual([p.partdata for p in BPart.at(datetime.now(),
+                link__document_id=d.document_id)], [12])
+        self.assertEqual(BPart.at(inter, link__document_id=d.document_id)
+                         .count(), 2)
+
 
 class DocumentPartFBTest(TestCase):
     def tearDown(self):
@@ -849,6 +1172,20 @@ class DocumentPartFBTest(TestCase):
         self.assertEqual(FBPart0.document_get(inter).partdata, 1)
         self.assertEqual(FBPart0.document_get(after).partdata, 2)
 
+    def test_bulk_documents_save_with_parts(self):
+        documents, parts = [], []
+        for i in range(3):
+            pp = FBPart()
+            parts += [FBPart0(partlink=pp, partdata=i), pp]
+            documents.append(DocumentFB(data=i, link=pp))
+        DocumentFB.bulk_documents_save_with_parts(documents, parts)
+        after = datetime.now()
+        self.assertEqual(FBPart.objects.count(), 3)
+        for i, d in enumerate(documents):
+            self.assertEqual(FBPart0.document_get(
+                    after, partlink__documentfb__document_id=d.document_id)\
+                .partdata, i)
+
 
 class DocumentFK(TestCase):
     def tearDown(self):
@@ -877,12 +1214,32 @@ class DocumentFK(TestCase):
         self.assertEqual(DocumentFKDestination.at(after).get(
             document_id=ds.link).data, 2)
 
-
 class SimpleDocumentChildTest(TestCase):
     def tearDown(self):
         SimpleDocument.objects.all().delete()
         SimpleDocumentChild.objects.all().delete()
 
+    def test_bulk_documents_save(self):
+        SimpleDocument(data=0).document_save()
+        docs = [SimpleDocumentChild(data=i, cdata=i * 10) for i in range(3)]
+        SimpleDocumentChild.bulk_documents_save(docs)
+        sleep(0.001)
+        t = datetime.now()
+        for d in docs:
+            self.assertEqual(d.pk, d.id)
+            self.assertEqual(d.document_id, d.id)
+            d.cdata += 1
+        SimpleDocumentChild.bulk_documents_save(docs[:2])
+        self.assertEqual(SimpleDocument.objects.count(), 6)
+        self.assertEqual(sorted(SimpleDocumentChild.at(datetime.now())
+                                .values_list('data', 'cdata')),
+                         [(0, 1), (1, 11), (2, 20)])
+        self.assertEqual(SimpleDocumentChild.document_get(
+                t, document_id=docs[1].document_id).cdata, 10)
+        self.assertEqual(SimpleDocument.document_get(
+                datetime.now(), document_id=docs[0].document_id)
+                .simpledocumentchild.cdata, 1)
+
     def test_document_save_0(self):
         d = SimpleDocumentChild(data=1, cdata=11)
         d.document_save()
@@ -1011,6 +1368,22 @@ class TestNow(TestCase):
         t2 = now()
         self.assertFalse(t1 == t2)
 
+    def test_now_thread(self):
+        t1 = datetime(2000, 1, 1)
+        set_now(t1)
+        times = []
+        thread = Thread(target=lambda: times.append(now()))
+        thread.start()
+        thread.join()
+        self.assertNotEqual(times[0], t1)
+        self.assertEqual(now(), t1)
+        with current_time(datetime(2001, 1, 1)):
+            self.assertEqual(now(), datetime(2001, 1, 1))
+        self.assertEqual(now(), t1)
+        with current_time(datetime(2001, 1, 1), snapshot=True):
+            self.assertEqual(now(), datetime(2001, 1, 1))
+        self.assertEqual(now(), t1)
+
 
 class TestNowManager(TestCase):
     def tearDown(self):
@@ -1045,3 +1418,735 @@ class Test_save_now(TestCase):
         id2 = d.id
         self.assertEqual(SimpleDocument.now.get().id, id2)
 
+
+
+class DeltaDocumentTest(TestCase):
+    def tearDown(self):
+        DeltaTextDocument.objects.all().delete()
+
+    def test_document_save(self):
+        d = DeltaTextDocument(data=1, text='a' * 100)
+        d.document_save()
+        times = []
+        for i in range(2, 6):
+            sleep(0.001)
+            d.data = i
+            if i != 3:
+                d.text = 'a' * 100 + str(i)
+            d.document_save()
+            times.append(datetime.now())
+            self.assertEqual(d.text[:100], 'a' * 100)
+        stored = DeltaTextDocument.objects.order_by('id')\
+                .values_list('text', 'document_delta')
+        self.assertEqual([t for t, delta in stored],
+                ['a' * 100, '', '', 'a' * 100 + '4', ''])
+        self.assertEqual([delta is None for t, delta in stored],
+                [True, False, False, True, False])
+        self.assertEqual(
+                DeltaTextDocument.at(times[0]).get().text, 'a' * 100 + '2')
+        self.assertEqual(
+                DeltaTextDocument.at(times[1]).get().text, 'a' * 100 + '2')
+        self.assertEqual(
+                DeltaTextDocument.at(times[3]).get().text, 'a' * 100 + '5')
+        self.assertEqual(DeltaTextDocument.document_get(
+                datetime.now(), document_id=d.document_id).text,
+                'a' * 100 + '5')
+        self.assertEqual([v.text[100:] for v in d.history()],
+                ['5', '4', '2', '2', ''])
+        self.assertEqual(list(DeltaTextDocument.at_values(
+                times[1], ['data', 'text'])), [(3, 'a' * 100 + '2')])
+        self.assertEqual([(r.data, r.text[100:]) for r in
+                d.history_records(['data', 'text'])],
+                [(5, '5'), (4, '4'), (3, '2'), (2, '2'), (1, '')])
+        record = next(d.history_records())
+        self.assertEqual(record.instance().text, 'a' * 100 + '5')
+
+    def test_bulk_documents_save(self):
+        d1 = DeltaTextDocument(data=1, text='first')
+        d2 = DeltaTextDocument(data=2, text='second')
+        DeltaTextDocument.bulk_documents_save([d1, d2])
+        sleep(0.001)
+        d1.text = 'first, changed'
+        d2.data = 3
+        DeltaTextDocument.bulk_documents_save([d1, d2])
+        self.assertEqual(DeltaTextDocument.objects.filter(
+                document_delta__isnull=True).count(), 2)
+        self.assertEqual(DeltaTextDocument.objects.filter(
+                document_delta__isnull=False, text='').count(), 2)
+        self.assertEqual(DeltaTextDocument.document_get(
+                datetime.now(), document_id=d1.document_id).text,
+                'first, changed')
+        self.assertEqual(DeltaTextDocument.document_get(
+                datetime.now(), document_id=d2.document_id).text,
+                'second')
+
+    def test_bulk_restore_to(self):
+        d = DeltaTextDocument(data=1, text='old')
+        d.document_save()
+        sleep(0.001)
+        t = datetime.now()
+        for i in range(4):
+            sleep(0.001)
+            d.text = 'new %d' % i
+            d.document_save()
+        DeltaTextDocument.bulk_restore_to(t, [d.document_id])
+        self.assertEqual(DeltaTextDocument.document_get(
+                datetime.now(), document_id=d.document_id).text, 'old')
+        self.assertEqual([v.text for v in d.history()][:2],
+                         ['old', 'new 3'])
+
+    def test_document_restore(self):
+        d = DeltaTextDocument(data=1, text='old')
+        d.document_save()
+        sleep(0.001)
+        t = datetime.now()
+        sleep(0.001)
+        d.text = 'new'
+        d.document_save()
+        DeltaTextDocument.document_get(t).document_restore()
+        self.assertEqual(
+                DeltaTextDocument.document_get(datetime.now()).text, 'old')
+
+    def test_delta_materialize(self):
+        from StringIO import StringIO
+        from documents.management.commands import drop_retrospection_data
+        from documents.management.commands.documentscheck import set_options
+        d = DeltaTextDocument(data=1, text='first')
+        d.document_save()
+        for text in ('second', 'third'):
+            d.text = text
+            d.document_save()
+        DeltaTextDocument.objects.filter(document_end__lt=FUTURE).delete()
+        self.assertRaises(DeltaTextDocument.DeltaChainBroken,
+                DeltaTextDocument.document_get,
+                datetime.now(), document_id=d.document_id)
+        DeltaTextDocument.objects.all().delete()
+        d = DeltaTextDocument(data=1, text='first')
+        d.document_save()
+        for text in ('second', 'third'):
+            d.text = text
+            d.document_save()
+        out = StringIO()
+        set_options(out, out, verbosity=1)
+        drop_retrospection_data.fix_model(DeltaTextDocument)
+        self.assertEqual(DeltaTextDocument.objects.count(), 1)
+        self.assertEqual(DeltaTextDocument.objects.get().text, 'third')
+
+
+class HashedDocumentTest(TestCase):
+    def tearDown(self):
+        HashedSimpleDocument.objects.all().delete()
+
+    def test_document_save(self):
+        d1 = HashedSimpleDocument(data=1)
+        d1.document_save()
+        d2 = HashedSimpleDocument(data=1)
+        HashedSimpleDocument.bulk_documents_save([d2])
+        self.assertEqual(len(d1.document_hash), 40)
+        self.assertEqual(d1.document_hash, d2.document_hash)
+        self.assertEqual(
+                HashedSimpleDocument.objects.get(id=d1.id).document_hash,
+                d1.document_hash)
+        d2.data = 2
+        self.assertNotEqual(d2.document_digest(), d1.document_hash)
+        self.assertEqual(d2.document_save(skip_if_unchanged=True), 0)
+        d1 = HashedSimpleDocument(data=1, document_id=d1.document_id)
+        self.assertEqual(d1.document_save(skip_if_unchanged=True), 1)
+
+    def test_changed_documents(self):
+        d1 = HashedSimpleDocument(data=1)
+        d2 = HashedSimpleDocument(data=2)
+        HashedSimpleDocument.bulk_documents_save([d1, d2])
+        d2.data = 3
+        self.assertEqual(HashedSimpleDocument.changed_documents(
+                [(d1.document_id, d1.document_digest()),
+                 (d2.document_id, d2.document_digest()),
+                 (d2.document_id + 1, d1.document_digest())]),
+                [d2.document_id, d2.document_id + 1])
+
+    def test_document_digest(self):
+        digests = [HashedPairDocument(first=a, second=b).document_digest()
+                   for a, b in [('a\x01', 'b'), ('a', '\x01b'),
+                                (None, 'b'), ('', 'b'), ('-', 'b')]]
+        self.assertEqual(len(set(digests)), len(digests))
+
+    def test_hash_index(self):
+        table = HashedSimpleDocument._meta.db_table
+        cursor = connection.cursor()
+        if 'postgresql' in settings.DATABASES['default']['ENGINE']:
+            cursor.execute('SELECT indexdef FROM pg_indexes '
+                           'WHERE tablename = %s', [table])
+        else:
+            cursor.execute("SELECT sql FROM sqlite_master "
+                           "WHERE type = 'index' AND tbl_name = %s", [table])
+        self.assertTrue([r for r in cursor.fetchall()
+                         if 'document_id' in r[0] and
+                            'document_hash' in r[0]])
+
+
+class ReturningDocumentTest(TestCase):
+    def tearDown(self):
+        ReturningDocument.objects.all().delete()
+
+    def test_document_save(self):
+        d = ReturningDocument(data=1)
+        d.document_save()
+        self.assertEqual(d.document_id, d.id)
+        id1 = d.id
+        d.data = 2
+        d.document_save()
+        self.assertNotEqual(d.id, id1)
+        self.assertEqual(d.document_id, id1)
+        d = ReturningDocument.document_get(
+                datetime.now(), document_id=d.document_id)
+        self.assertEqual(d.data, 2)
+        self.assertEqual(ReturningDocument.objects.count(), 2)
+        d.id = id1
+        self.assertRaises(ReturningDocument.ChangedAlready, d.document_save)
+
+    def test_save_overridden(self):
+        self.assertFalse(ReturningDocument._save_overridden())
+        self.assertTrue(DeltaTextDocument._save_overridden())
+        self.assertFalse(ReturningDocument._new_document_id_overridden())
+        self.assertTrue(
+                ReturningNumberedDocument._new_document_id_overridden())
+        d = ReturningNumberedDocument(data=1)
+        d.document_save()
+        self.assertEqual(d.document_id, d.id + 1000)
+        ReturningNumberedDocument.objects.all().delete()
+
+    @unittest.skipUnless(POSTGRESQL, 'PostgreSQL only')
+    def test_returning_statement(self):
+        saved = []
+        def on_save(sender, instance, **kwargs):
+            saved.append(instance)
+        post_save.connect(on_save, sender=ReturningDocument)
+        try:
+            d = ReturningDocument(data=1)
+            d.document_save()
+            id1 = d.id
+            d.data = 2
+            d.document_save()
+        finally:
+            post_save.disconnect(on_save, sender=ReturningDocument)
+        # written by the statement, not by save()
+        self.assertEqual(saved, [])
+        self.assertEqual(list(ReturningDocument.objects.order_by('id')
+                .values_list('id', 'document_id', 'data')),
+                [(id1, id1, 1), (d.id, id1, 2)])
+        self.assertEqual(ReturningDocument.objects.get(id=id1).document_end,
+                         d.document_start)
+        stale = ReturningDocument.objects.get(id=id1)
+        stale.data = 3
+        self.assertRaises(ReturningDocument.ChangedAlready,
+                          stale.document_save)
+        self.assertEqual(ReturningDocument.objects.count(), 2)
+
+
+class LockedDocumentTest(TestCase):
+    def tearDown(self):
+        LockedDocument.objects.all().delete()
+
+    def test_document_save(self):
+        d1 = LockedDocument(data=1)
+        d1.document_save()
+        d2 = LockedDocument(data=2)
+        LockedDocument.bulk_documents_save([d2])
+        d1.data = 3
+        d1.document_save()
+        d2 = LockedDocument(data=4, document_id=d2.document_id)
+        LockedDocument.bulk_documents_save([d2])
+        self.assertEqual(LockedDocument.objects.count(), 4)
+        self.assertEqual(sorted(LockedDocument.at(datetime.now())
+                .values_list('data', flat=True)), [3, 4])
+        LockedDocument.objects.get(data=1).document_restore()
+        self.assertEqual(sorted(LockedDocument.at(datetime.now())
+                .values_list('data', flat=True)), [1, 4])
+
+
+class LockedDocumentLockTest(TransactionTestCase):
+    @unittest.skipUnless(POSTGRESQL, 'PostgreSQL only')
+    def test_writers_serialized(self):
+        d = LockedDocument(data=1)
+        d.document_save()
+        other = LockedDocument(data=1)
+        other.document_save()
+        events = []
+        locked = Event()
+
+        def hold():
+            try:
+                with transaction.commit_on_success():
+                    LockedDocument.document_lock([d.document_id])
+                    locked.set()
+                    sleep(0.5)
+                    events.append('released')
+            finally:
+                connection.close()
+
+        t = Thread(target=hold)
+        t.start()
+        locked.wait()
+        other.data = 2
+        other.document_save()   # other documents are not locked
+        events.append('other saved')
+        d.data = 2
+        d.document_save()       # waits for the lock
+        events.append('saved')
+        t.join()
+        self.assertEqual(events, ['other saved', 'released', 'saved'])
+        self.assertEqual(LockedDocument.objects.count(), 4)
+
+
+class BufferedWriterTest(TestCase):
+    def tearDown(self):
+        SimpleDocument.objects.all().delete()
+
+    def test_flush(self):
+        w = BufferedWriter(SimpleDocument, background=False)
+        d1 = SimpleDocument(data=1)
+        d2 = SimpleDocument(data=2, document_id=123)
+        w.document_save(d1)
+        w.document_save(d2)
+        self.assertEqual(d1.document_start, d2.document_start)
+        d2.data = 3
+        w.document_save(d2)
+        self.assertEqual(SimpleDocument.objects.count(), 0)
+        w.flush()
+        self.assertEqual(SimpleDocument.objects.count(), 2)
+        self.assertEqual(SimpleDocument.document_get(
+                datetime.now(), document_id=123).data, 3)
+        self.assertEqual(d1.document_id, d1.id)
+
+    def test_flush_size(self):
+        w = BufferedWriter(SimpleDocument, flush_size=2, background=False)
+        w.document_save(SimpleDocument(data=1))
+        self.assertEqual(SimpleDocument.objects.count(), 0)
+        w.document_save(SimpleDocument(data=2))
+        self.assertEqual(SimpleDocument.objects.count(), 2)
+        with w.commit_on_success():
+            w.document_save(SimpleDocument(data=3))
+        self.assertEqual(SimpleDocument.objects.count(), 3)
+
+    def test_conflicts(self):
+        d = SimpleDocument(data=1)
+        d.document_save()
+        stale = SimpleDocument.objects.get(id=d.id)
+        d.data = 2
+        d.document_save()
+        w = BufferedWriter(SimpleDocument, background=False)
+        stale.data = 3
+        w.document_save(stale)
+        new = SimpleDocument(data=4)
+        w.document_save(new)
+        self.assertEqual(w.flush(), [stale])
+        self.assertEqual(w.conflicts, [stale])
+        self.assertEqual(SimpleDocument.document_get(
+                datetime.now(), document_id=new.document_id).data, 4)
+        self.assertEqual(SimpleDocument.document_get(
+                datetime.now(), document_id=d.document_id).data, 2)
+
+    def test_failed_flush(self):
+        class Failure(Exception):
+            pass
+
+        def fail(documents, *args, **kwargs):
+            for d in documents:
+                d.id = d.document_id = 1000
+            raise Failure()
+
+        w = BufferedWriter(SimpleDocument, background=False)
+        d = SimpleDocument(data=1)
+        w.document_save(d)
+        w.model = type('FailingDocument', (object,),
+                       {'bulk_documents_save': staticmethod(fail)})
+        self.assertRaises(Failure, w.flush)
+        self.assertEqual((d.id, d.document_id), (None, 0))
+        w.model = SimpleDocument
+        w.flush()
+        self.assertEqual(SimpleDocument.document_get(
+                datetime.now(), document_id=d.document_id).data, 1)
+
+
+class BufferedWriterTransactionTest(TransactionTestCase):
+    def test_failed_flush(self):
+        w = BufferedWriter(SimpleDocument, background=False)
+        good = SimpleDocument(data=1)
+        bad = SimpleDocument(data=None)
+        w.document_save(good, datetime.now())
+        w.document_save(bad, datetime.now() + timedelta(seconds=1))
+        self.assertRaises(IntegrityError, w.flush)
+        # the first batch is not committed without the second one
+        self.assertEqual(SimpleDocument.objects.count(), 0)
+        bad.data = 2
+        w.flush()
+        self.assertEqual(sorted(SimpleDocument.objects
+                .values_list('document_id', 'data')),
+                [(good.document_id, 1), (bad.document_id, 2)])
+
+    def test_isolate(self):
+        w = BufferedWriter(SimpleDocument, background=False)
+        good = SimpleDocument(data=1)
+        bad = SimpleDocument(data=None)
+        w.document_save(good)
+        w.document_save(bad)
+        w._flush(isolate=True)
+        self.assertEqual(list(SimpleDocument.objects
+                .values_list('document_id', 'data')),
+                [(good.document_id, 1)])
+        self.assertEqual([d for d, e in w.failed], [bad])
+        self.assertTrue(isinstance(w.failed[0][1], IntegrityError))
+        self.assertEqual((bad.id, bad.document_id), (None, 0))
+        self.assertEqual(w.flush(), [])
+
+
+class SessionAccess(dict):
+    def __getitem__(self, key):
+        self.accessed = True
+        return super(SessionAccess, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super(SessionAccess, self).get(key, default)
+
+    def get_expiry_age(self):
+        return 1209600
+
+    def get_expire_at_browser_close(self):
+        return False
+
+
+class TestRetrospectionMiddleware(TestCase):
+    def request(self, path, session, cookies=None):
+        request = RequestFactory().get(path)
+        request.session = session
+        request.COOKIES.update(cookies or {})
+        return request
+
+    def test_no_retrospection(self):
+        m = RetrospectionMiddleware()
+        session = SessionAccess()
+        request = self.request('/', session)
+        m.process_request(request)
+        self.assertFalse(hasattr(session, 'accessed'))
+        self.assertEqual(request.retrospection_dt, None)
+        self.assertEqual(retrospection_context_processor(request), {})
+        response = m.process_response(request, HttpResponse())
+        self.assertFalse(m.cookie_name in response.cookies)
+
+    def test_retrospection(self):
+        m = RetrospectionMiddleware()
+        session = SessionAccess()
+        dt = datetime(2000, 1, 1).strftime(DATETIME_FORMAT)
+        request = self.request('/', session)
+        request.GET = {m.enter_param: dt}
+        m.process_request(request)
+        dt = datetime.strptime(dt, DATETIME_FORMAT)
+        self.assertEqual(now(), dt)
+        response = m.process_response(request, HttpResponse())
+        self.assertEqual(response.cookies[m.cookie_name].value, '1')
+        self.assertEqual(response.cookies[m.cookie_name]['max-age'], 1209600)
+        self.assertNotEqual(now(), dt)
+
+        request = self.request('/', session, {m.cookie_name: '1'})
+        m.process_request(request)
+        self.assertEqual(request.retrospection_dt, dt)
+        self.assertEqual(now(request), dt)
+        self.assertEqual(retrospection_context_processor(request),
+                         {'retrospection_dt': dt})
+        response = m.process_response(request, HttpResponse())
+        # renewed with the session
+        self.assertEqual(response.cookies[m.cookie_name].value, '1')
+
+        router = RetrospectionRouter()
+        router.database = 'replica'
+        request = self.request('/', session, {m.cookie_name: '1'})
+        m.process_request(request)
+        self.assertEqual(router.db_for_read(SimpleDocument), 'replica')
+        self.assertEqual(router.db_for_write(SimpleDocument), None)
+        m.process_response(request, HttpResponse())
+        self.assertEqual(router.db_for_read(SimpleDocument), None)
+
+        request = self.request(
+                '/?exit_retrospection=1', session, {m.cookie_name: '1'})
+        m.process_request(request)
+        self.assertFalse(NOW_FIELD in session)
+        response = m.process_response(request, HttpResponse())
+        self.assertEqual(response.cookies[m.cookie_name].value, '')
+
+    def test_expired_cookie(self):
+        m = RetrospectionMiddleware()
+        fmt = '%Y-%m-%d %H:%M:%S'
+        old_format, retrospection.DATETIME_FORMAT = \
+                retrospection.DATETIME_FORMAT, fmt
+        try:
+            # the time is left in the session, but the cookie has expired
+            session = SessionAccess(
+                    {NOW_FIELD: datetime(2001, 1, 1).strftime(fmt)})
+            dt = datetime(2020, 5, 5)
+            request = self.request('/', session)
+            request.GET = {m.enter_param: dt.strftime(fmt)}
+            m.process_request(request)
+            self.assertEqual(request.retrospection_dt, dt)
+            self.assertEqual(now(), dt)
+            response = m.process_response(request, HttpResponse())
+            self.assertEqual(response.cookies[m.cookie_name].value, '1')
+            request = self.request('/', session, {m.cookie_name: '1'})
+            m.process_request(request)
+            self.assertEqual(request.retrospection_dt, dt)
+            m.process_response(request, HttpResponse())
+        finally:
+            retrospection.DATETIME_FORMAT = old_format
+
+
+ROUTER_SETTINGS = '''
+from django.conf import settings
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                           'NAME': ':memory:'}},
+    INSTALLED_APPS=('documents',),
+    DATABASE_ROUTERS=['documents.routers.RetrospectionRouter'])
+from django.db import router
+from documents.models import Document
+print(router.routers[0].db_for_read(Document))
+'''
+
+
+class RetrospectionRouterTest(TestCase):
+    def test_settings(self):
+        # a new interpreter, as django.db loads the routers on import
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        env.pop('DJANGO_SETTINGS_MODULE', None)
+        process = subprocess.Popen(
+                [sys.executable, '-c', ROUTER_SETTINGS], env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual((process.returncode, output.strip()),
+                         (0, b'None'), output)
+
+
+class PreparedDocumentTest(TestCase):
+    def tearDown(self):
+        PreparedDocument.objects.all().delete()
+
+    def test_document_get(self):
+        d = PreparedDocument(data=1)
+        d.document_save()
+        sleep(0.001)
+        t = datetime.now()
+        d.data = 2
+        d.document_save()
+        self.assertEqual(PreparedDocument.document_get(
+                t, document_id=d.document_id).data, 1)
+        self.assertEqual(PreparedDocument.document_get(
+                datetime.now(), document_id=d.document_id).data, 2)
+        self.assertRaises(PreparedDocument.DoesNotExist,
+                PreparedDocument.document_get,
+                datetime.now(), document_id=d.document_id + 1)
+        d.id -= 1
+        self.assertRaises(PreparedDocument.ChangedAlready, d.document_save)
+        self.assertEqual(d.document_delete(), 1)
+        self.assertRaises(PreparedDocument.DoesNotExist,
+                PreparedDocument.document_get,
+                datetime.now(), document_id=d.document_id)
+
+    def test_execute(self):
+        class Cursor(object):
+            def __init__(self, log):
+                self.log = log
+
+            def execute(self, sql, params=None):
+                self.log.append((sql, params))
+
+        class Connection(object):
+            connection = object()
+
+            def __init__(self):
+                self.log = []
+
+            def cursor(self):
+                return Cursor(self.log)
+
+        fake = Connection()
+        old_connection, old_max = prepared.connection, prepared.PREPARED_MAX
+        prepared.connection, prepared.PREPARED_MAX = fake, 2
+        prepared.reset_stats()
+        try:
+            for sql in ('SELECT %s', 'SELECT %s, %s', 'SELECT %s', 'S 3'):
+                prepared.execute(sql, [1] * sql.count('%s'))
+        finally:
+            prepared.connection = old_connection
+            prepared.PREPARED_MAX = old_max
+        self.assertEqual(prepared.stats,
+                         {'hits': 1, 'misses': 3, 'evictions': 1})
+        names = [sql.split()[1] for sql, params in fake.log
+                 if sql.startswith('PREPARE')]
+        self.assertEqual(fake.log[0], ('PREPARE %s AS SELECT $1' % names[0],
+                                       None))
+        self.assertEqual(fake.log[1], ('EXECUTE %s (%%s)' % names[0], [1]))
+        self.assertEqual(fake.log[4], ('EXECUTE %s (%%s)' % names[0], [1]))
+        # 'SELECT %s, %s' is the least recently used one
+        self.assertEqual(fake.log[5], ('DEALLOCATE %s' % names[1], None))
+        self.assertEqual(len(fake.log), 8)
+        self.assertEqual(fake._documents_prepared[1].keys(),
+                         ['SELECT %s', 'S 3'])
+
+
+class DocumentChangeTest(TestCase):
+    def tearDown(self):
+        LoggedDocument.objects.all().delete()
+        DocumentChange.objects.all().delete()
+        DocumentChangeCursor.objects.all().delete()
+
+    def test_changes(self):
+        d = LoggedDocument(data=1)
+        d.document_save()
+        SimpleDocument(data=1).document_save()  # not logged
+        d.data = 2
+        d.document_save()
+        docs = [LoggedDocument(data=i) for i in range(3)]
+        LoggedDocument.bulk_documents_save(docs)
+        d.document_delete()
+        LoggedDocument.bulk_documents_delete(docs[:2])
+        changes = DocumentChange.since('test')
+        self.assertEqual([(c.kind, c.document_id) for c in changes],
+                [(DocumentChange.SAVED, d.document_id)] * 2 +
+                [(DocumentChange.SAVED, x.document_id) for x in docs] +
+                [(DocumentChange.DELETED, d.document_id)] +
+                [(DocumentChange.DELETED, x.document_id) for x in docs[:2]])
+        self.assertEqual(changes[1].version_id, d.id)
+        self.assertEqual(set(c.model for c in changes),
+                         set(['documents.LoggedDocument']))
+        self.assertEqual(len(DocumentChange.since('test', limit=2)), 2)
+        DocumentChangeCursor.advance('test', changes[4])
+        self.assertEqual(DocumentChange.since('test'), changes[5:])
+        DocumentChangeCursor.advance('test', changes[-1])
+        self.assertEqual(DocumentChange.since('test'), [])
+        self.assertEqual(len(DocumentChange.since('other')), len(changes))
+
+    def test_log(self):
+        t = datetime.now()
+        with self.assertNumQueries(1):
+            DocumentChange.log(LoggedDocument, DocumentChange.SAVED,
+                               [(1, 1), (2, 2), (3, 3)], t)
+        changes = DocumentChange.since('test')
+        self.assertEqual([(c.document_id, c.version_id, c.time)
+                          for c in changes], [(i, i, t) for i in (1, 2, 3)])
+        self.assertEqual(len(set(c.txid for c in changes)), 1)
+
+    def test_bulk_restore_to(self):
+        d1, d2 = LoggedDocument(data=1), LoggedDocument(data=2)
+        d1.document_save()
+        sleep(0.001)
+        t = datetime.now()
+        sleep(0.001)
+        d1.data = 10
+        d1.document_save()
+        d2.document_save()
+        DocumentChangeCursor.advance('test', DocumentChange.objects.latest(
+                'id'))
+        LoggedDocument.bulk_restore_to(t)
+        restored = LoggedDocument.document_get(
+                datetime.now(), document_id=d1.document_id)
+        self.assertEqual(restored.data, 1)
+        self.assertEqual(sorted((c.kind, c.document_id, c.version_id)
+                                for c in DocumentChange.since('test')),
+                sorted([(DocumentChange.SAVED, d1.document_id, restored.id),
+                        (DocumentChange.DELETED, d2.document_id, None)]))
+
+
+class BulkRestoreTest(TestCase):
+    def tearDown(self):
+        FlatDocument.objects.all().delete()
+        SimpleDocument.objects.all().delete()
+
+    def test_bulk_restore_to(self):
+        docs = [FlatDocument(data=i) for i in range(4)]
+        FlatDocument.bulk_documents_save(docs)
+        sleep(0.001)
+        t = datetime.now()
+        sleep(0.001)
+        for d in docs:
+            d.data += 10
+        FlatDocument.bulk_documents_save(docs[:2])
+        docs[2].document_delete()
+        new = FlatDocument(data=100)
+        new.document_save()
+        ids = [d.document_id for d in docs] + [new.document_id]
+        FlatDocument.bulk_restore_to(t, ids[1:])
+        state = lambda: sorted(
+                FlatDocument.at(datetime.now())\
+                .values_list('document_id', 'data'))
+        self.assertEqual(state(), [(ids[0], 10), (ids[1], 1),
+                                   (ids[2], 2), (ids[3], 3)])
+        self.assertEqual(FlatDocument.objects.count(), 9)
+        FlatDocument.bulk_restore_to(t)
+        self.assertEqual(state(), [(ids[0], 0), (ids[1], 1),
+                                   (ids[2], 2), (ids[3], 3)])
+        # documents 1 and 2 are restored again
+        self.assertEqual(FlatDocument.objects.count(), 12)
+
+    def test_checks(self):
+        d = FlatDocument(data=1)
+        d.document_save()
+        t = datetime.now()
+        sleep(0.001)
+        d.data = 2
+        d.document_save()
+        # earlier than the start of the current version
+        self.assertRaises(AssertionError, FlatDocument.bulk_restore_to,
+                          t, [d.document_id], t + timedelta(microseconds=1))
+        self.assertEqual(FlatDocument.document_get(
+                datetime.now(), document_id=d.document_id).data, 2)
+        # SimpleDocumentChild rows would not be copied
+        self.assertEqual(SimpleDocument.document_children(),
+                         [SimpleDocumentChild])
+        self.assertRaises(AssertionError, SimpleDocument.bulk_restore_to, t)
+
+
+class ReadPoolTest(TestCase):
+    def setUp(self):
+        self.pool = ReadPool(1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_time(self):
+        for dt in (datetime(2000, 1, 1), datetime(2001, 1, 1)):
+            with current_time(dt):
+                result = self.pool.run(now)
+            self.assertEqual(result.result(5), dt)
+            self.assertTrue(result.done())
+
+    def test_error(self):
+        done = []
+        result = self.pool.run(int, 'x')
+        self.assertRaises(ValueError, result.result, 5)
+        result.add_done_callback(done.append)
+        self.assertEqual(done, [result])
+
+    def test_callback(self):
+        started, done = Event(), Event()
+        result = self.pool.run(lambda: started.wait(5) and 1)
+        result.add_done_callback(lambda r: done.set())
+        self.assertFalse(done.is_set())
+        self.assertRaises(result.Timeout, result.result, 0.01)
+        started.set()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(result.result(), 1)
+
+
+class ReadPoolQueryTest(TransactionTestCase):
+    @unittest.skipIf('sqlite' in settings.DATABASES['default']['ENGINE'],
+                     'the test database is not shared by threads')
+    def test_document_get(self):
+        d = SimpleDocument(data=1)
+        d.document_save()
+        pool = ReadPool(2)
+        try:
+            results = [pool.run(SimpleDocument.document_get, datetime.now(),
+                                document_id=d.document_id)
+                       for i in range(4)]
+            self.assertEqual([r.result(5).data for r in results], [1] * 4)
+        finally:
+            pool.close()